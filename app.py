@@ -1,13 +1,18 @@
 import os
+import re
 import secrets
 import requests
 import base64
 import json
 import hmac
 import hashlib
+import threading
+import time
 from cryptography.fernet import Fernet
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_from_directory, session
+from flask import Flask, Response, g, has_app_context, has_request_context, render_template, request, redirect, url_for, flash, jsonify, send_from_directory, session, stream_with_context
+from flask.logging import default_handler
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSQLAlchemySession
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from flask_mail import Mail, Message
 from flask_wtf import FlaskForm
@@ -17,16 +22,51 @@ from wtforms import StringField, TextAreaField, DecimalField, IntegerField, Sele
 from wtforms.validators import DataRequired, Email, Length, NumberRange, EqualTo
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from sqlalchemy import Select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
 from itsdangerous import URLSafeTimedSerializer
 from datetime import datetime, timedelta
-from PIL import Image
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import io
+import csv
+import atexit
+import sqlite3
+import logging
+import mimetypes
+import multiprocessing
+import random
+import sys
+import queue
+import shutil
+import tempfile
+from collections import OrderedDict
+from functools import wraps
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from dotenv import load_dotenv
+from image_pipeline import render_image_variants
 
 load_dotenv()
 
 # Initialize extensions
-db = SQLAlchemy()
+class RoutingSession(FlaskSQLAlchemySession):
+    """Session that sends SELECTs to a read replica once a view opts in with read_from_replica.
+    
+    Writes always go to the primary, and so does everything after the
+    session's first write, so a request reads back what it just wrote.
+    """
+    
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and isinstance(clause, Select)
+                and self.info.get('use_replica') and not self.info.get('wrote')):
+            return self._db.engines[random.choice(list(REPLICA_BINDS))]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 login_manager = LoginManager()
 mail = Mail()
 migrate = Migrate()
@@ -37,6 +77,20 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL', 'sqlite:///herbs_store.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     
+    # Database Engine (SQLite pragmas apply to every connection; pool settings to server databases)
+    SQLITE_TUNING = os.getenv('SQLITE_TUNING', 'True').lower() == 'true'
+    SQLITE_BUSY_TIMEOUT = int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000))  # milliseconds
+    SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))  # bytes
+    SQLITE_CACHE_SIZE = int(os.getenv('SQLITE_CACHE_SIZE', 64 * 1024))  # KiB per connection
+    DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+    DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 20))
+    DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', 30))
+    DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+    
+    # Read Replicas (comma-separated URLs; see read_from_replica)
+    DATABASE_REPLICA_URLS = os.getenv('DATABASE_REPLICA_URLS', '')
+    READ_YOUR_WRITES_SECONDS = int(os.getenv('READ_YOUR_WRITES_SECONDS', 10))
+    
     # Email Configuration
     MAIL_SERVER = os.getenv('MAIL_SERVER', 'smtp.gmail.com')
     MAIL_PORT = int(os.getenv('MAIL_PORT', 587))
@@ -44,10 +98,28 @@ class Config:
     MAIL_USERNAME = os.getenv('MAIL_USERNAME', 'mugambiallan@gmail.com')
     MAIL_PASSWORD = os.getenv('MAIL_PASSWORD', 'amunene188,')
     MAIL_DEFAULT_SENDER = os.getenv('MAIL_DEFAULT_SENDER', 'mugambiallan@gmail.com')
+    ADMIN_ALERT_EMAIL = os.getenv('ADMIN_ALERT_EMAIL', MAIL_DEFAULT_SENDER)  # Payments that need a refund
+    
+    # Email Outbox
+    EMAIL_BATCH_SIZE = int(os.getenv('EMAIL_BATCH_SIZE', 20))
+    EMAIL_MAX_ATTEMPTS = int(os.getenv('EMAIL_MAX_ATTEMPTS', 5))
+    EMAIL_RETRY_DELAY = int(os.getenv('EMAIL_RETRY_DELAY', 30))
+    EMAIL_POLL_INTERVAL = int(os.getenv('EMAIL_POLL_INTERVAL', 30))
     
     # File Upload
     UPLOAD_FOLDER = os.getenv('UPLOAD_FOLDER', 'static/uploads')
     MAX_CONTENT_LENGTH = int(os.getenv('MAX_CONTENT_LENGTH', 16777216))
+    IMAGE_VARIANT_WIDTHS = [int(w) for w in os.getenv('IMAGE_VARIANT_WIDTHS', '160,320,640,1280').split(',')]
+    PRODUCT_CARD_IMAGE_SIZES = '(max-width: 480px) 100vw, (max-width: 768px) 50vw, 300px'
+    IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', 2))  # 0 processes images inline
+    
+    # Catalog
+    PRODUCTS_PER_PAGE = int(os.getenv('PRODUCTS_PER_PAGE', 24))
+    SEARCH_BACKEND = os.getenv('SEARCH_BACKEND', 'auto')  # auto, fts5, postgres or like
+    
+    # Admin
+    ADMIN_PER_PAGE = int(os.getenv('ADMIN_PER_PAGE', 50))
+    EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))  # Rows fetched per round-trip while exporting
     
     # M-Pesa Configuration
     MPESA_CONSUMER_KEY = os.getenv('MPESA_CONSUMER_KEY', 'O9B4B4x4Ank2GjzlyAx1lIggvzq36HmkdLjhTlZ458TPGoFT')
@@ -56,6 +128,49 @@ class Config:
     MPESA_PASSKEY = os.getenv('MPESA_PASSKEY', 'bfb279f9aa9bdbcf158e97dd71a467cd2e0c893059b10f78e6b72ada1ed2c919')
     MPESA_CALLBACK_URL = os.getenv('MPESA_CALLBACK_URL', 'https://your-ngrok-url.ngrok.io/mpesa-callback')
     MPESA_ENVIRONMENT = os.getenv('MPESA_ENVIRONMENT', 'sandbox')
+    MPESA_TIMEOUT = int(os.getenv('MPESA_TIMEOUT', 30))
+    MPESA_POOL_SIZE = int(os.getenv('MPESA_POOL_SIZE', 10))
+    MPESA_TOKEN_REFRESH_MARGIN = int(os.getenv('MPESA_TOKEN_REFRESH_MARGIN', 60))
+    MPESA_CALLBACK_FAST_ACK = os.getenv('MPESA_CALLBACK_FAST_ACK', 'True').lower() == 'true'
+    MPESA_CALLBACK_RETRY_MINUTES = int(os.getenv('MPESA_CALLBACK_RETRY_MINUTES', 60))  # How long failed callbacks are retried
+    
+    # Inventory
+    STOCK_RESERVATION_MINUTES = int(os.getenv('STOCK_RESERVATION_MINUTES', 15))
+    
+    # Background Jobs
+    BACKGROUND_WORKERS = int(os.getenv('BACKGROUND_WORKERS', 4))
+    PAYMENT_SWEEP_INTERVAL = int(os.getenv('PAYMENT_SWEEP_INTERVAL', 30))  # Seconds between payment sweeps
+    
+    # Cache (use 'redis' when running more than one gunicorn worker)
+    CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'local')
+    CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', 10000))
+    CART_COUNT_CACHE_TTL = int(os.getenv('CART_COUNT_CACHE_TTL', 300))
+    PRODUCT_PICTURE_CACHE_TTL = int(os.getenv('PRODUCT_PICTURE_CACHE_TTL', 1800))  # Keep below S3_URL_EXPIRES
+    CATALOG_CACHE_TTL = int(os.getenv('CATALOG_CACHE_TTL', 300))
+    DASHBOARD_STATS_CACHE_TTL = int(os.getenv('DASHBOARD_STATS_CACHE_TTL', 60))
+    
+    # Payment Events (use 'redis' when running more than one gunicorn worker)
+    PAYMENT_EVENTS_BACKEND = os.getenv('PAYMENT_EVENTS_BACKEND', 'local')
+    REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+    PAYMENT_EVENTS_TIMEOUT = int(os.getenv('PAYMENT_EVENTS_TIMEOUT', 120))
+    PAYMENT_EVENTS_KEEPALIVE = int(os.getenv('PAYMENT_EVENTS_KEEPALIVE', 15))
+    PAYMENT_EVENTS_MAX_STREAMS = int(os.getenv('PAYMENT_EVENTS_MAX_STREAMS', 4))  # Per worker; keep well below gunicorn --threads
+    
+    # Upload Storage ('filesystem' keeps files in UPLOAD_FOLDER; 's3' works with any S3-compatible service)
+    STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'filesystem')
+    S3_BUCKET = os.getenv('S3_BUCKET', '')
+    S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL', '')  # e.g. http://localhost:9000 for MinIO
+    S3_REGION = os.getenv('S3_REGION', '')
+    S3_ACCESS_KEY_ID = os.getenv('S3_ACCESS_KEY_ID', '')
+    S3_SECRET_ACCESS_KEY = os.getenv('S3_SECRET_ACCESS_KEY', '')
+    S3_PUBLIC_URL = os.getenv('S3_PUBLIC_URL', '')  # CDN or public bucket URL; pre-signed URLs otherwise
+    S3_URL_EXPIRES = int(os.getenv('S3_URL_EXPIRES', 3600))
+    
+    # Logging
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+    LOG_LEVELS = os.getenv('LOG_LEVELS', '')  # Per-logger overrides, e.g. "app.mpesa=DEBUG,sqlalchemy.engine=INFO"
+    LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')  # 'json' or 'text'
+    LOG_DEBUG_SAMPLE_RATE = float(os.getenv('LOG_DEBUG_SAMPLE_RATE', 0.01))
     
     # Product Categories
     CATEGORIES = [
@@ -66,10 +181,182 @@ class Config:
 app = Flask(__name__)
 app.config.from_object(Config)
 
+# Logging
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'request_id', 'sampled'}
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; fields passed through extra= are included"""
+    
+    def format(self, record):
+        entry = {
+            'time': datetime.utcfromtimestamp(record.created).isoformat(timespec='milliseconds') + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None)
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES})
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class RequestIdFilter(logging.Filter):
+    """Tag records with the ID of the request or job that logged them"""
+    
+    def filter(self, record):
+        record.request_id = g.get('request_id') if has_app_context() else None
+        return True
+
+class DebugSampler(logging.Filter):
+    """Keep only a fraction of DEBUG records so verbose loggers stay cheap in production"""
+    
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+    
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate >= 1:
+            return True
+        record.sampled = self.rate
+        return random.random() < self.rate
+
+def configure_logging(app):
+    """Route every logger through a queue so requests never block on log output.
+    
+    Records are filtered and formatted in the calling thread and written to
+    stdout by a QueueListener thread.
+    """
+    if app.config['LOG_FORMAT'] == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s')
+    
+    queue_handler = QueueHandler(queue.SimpleQueue())
+    queue_handler.setFormatter(formatter)
+    queue_handler.addFilter(RequestIdFilter())
+    queue_handler.addFilter(DebugSampler(app.config['LOG_DEBUG_SAMPLE_RATE']))
+    
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter('%(message)s'))
+    listener = QueueListener(queue_handler.queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(app.config['LOG_LEVEL'].upper())
+    app.logger.removeHandler(default_handler)
+    
+    for override in filter(None, app.config['LOG_LEVELS'].split(',')):
+        name, _, level = override.partition('=')
+        logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+configure_logging(app)
+mpesa_logger = logging.getLogger('app.mpesa')
+email_logger = logging.getLogger('app.email')
+catalog_logger = logging.getLogger('app.catalog')
+request_logger = logging.getLogger('app.requests')
+
+@app.before_request
+def assign_request_id():
+    """Reuse the proxy's X-Request-ID when it looks sane, otherwise make one up"""
+    request_id = request.headers.get('X-Request-ID', '')
+    g.request_id = request_id if re.fullmatch(r'[\w.-]{1,64}', request_id) else secrets.token_hex(8)
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def log_request(response):
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+        request_logger.debug("Request finished", extra={
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'duration_ms': round((time.perf_counter() - g.request_started) * 1000, 2)
+        })
+    return response
+
 # Ensure upload directory exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'products'), exist_ok=True)
 os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'users'), exist_ok=True)
+os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'tmp'), exist_ok=True)
+
+# Database Engine
+def database_engine_options(config):
+    """SQLAlchemy engine options for the configured database"""
+    if config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        # Pragmas are applied per connection by configure_sqlite_connection()
+        return {}
+    return {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        # Drop connections the server or a proxy closed while they sat idle
+        'pool_pre_ping': True,
+        'pool_recycle': config['DB_POOL_RECYCLE']
+    }
+
+def normalize_database_url(url):
+    """Render and Heroku hand out postgres:// URLs, which SQLAlchemy no longer accepts"""
+    return url.replace('postgres://', 'postgresql://', 1) if url.startswith('postgres://') else url
+
+app.config['SQLALCHEMY_DATABASE_URI'] = normalize_database_url(app.config['SQLALCHEMY_DATABASE_URI'])
+app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', database_engine_options(app.config))
+
+# Replicas are extra binds; no model uses them directly, RoutingSession picks one per query
+REPLICA_BINDS = {
+    f'replica_{i}': normalize_database_url(url.strip())
+    for i, url in enumerate(url for url in app.config['DATABASE_REPLICA_URLS'].split(',') if url.strip())
+}
+app.config['SQLALCHEMY_BINDS'] = {**app.config.get('SQLALCHEMY_BINDS', {}), **REPLICA_BINDS}
+
+@db.event.listens_for(Engine, 'connect')
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    """Let SQLite readers and writers from several gunicorn workers run side by side.
+    
+    WAL lets readers proceed while a checkout or callback is writing, and
+    busy_timeout makes writers queue for the lock instead of failing with
+    "database is locked". synchronous=NORMAL is durable across application
+    crashes in WAL mode and skips an fsync per commit.
+    """
+    if not isinstance(dbapi_connection, sqlite3.Connection) or not app.config['SQLITE_TUNING']:
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute(f"PRAGMA busy_timeout={app.config['SQLITE_BUSY_TIMEOUT']}")
+    cursor.execute(f"PRAGMA mmap_size={app.config['SQLITE_MMAP_SIZE']}")
+    cursor.execute(f"PRAGMA cache_size=-{app.config['SQLITE_CACHE_SIZE']}")
+    cursor.close()
+
+@db.event.listens_for(db.session, 'after_flush')
+def note_flush_write(db_session, flush_context):
+    db_session.info['wrote'] = True
+
+@db.event.listens_for(db.session, 'do_orm_execute')
+def note_statement_write(orm_execute_state):
+    if not orm_execute_state.is_select:
+        orm_execute_state.session.info['wrote'] = True
+
+@db.event.listens_for(db.session, 'after_commit')
+def stick_to_primary(db_session):
+    """Keep a client that just wrote on the primary until replicas have caught up"""
+    if REPLICA_BINDS and db_session.info.get('wrote') and has_request_context():
+        session['primary_until'] = time.time() + app.config['READ_YOUR_WRITES_SECONDS']
+
+def read_from_replica(view):
+    """Serve a read-mostly view's queries from a read replica.
+    
+    Clients that wrote within READ_YOUR_WRITES_SECONDS stay on the primary so
+    they see their own changes despite replication lag.
+    """
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if REPLICA_BINDS and session.get('primary_until', 0) < time.time():
+            db.session.info['use_replica'] = True
+        return view(*args, **kwargs)
+    return wrapped
 
 # Initialize extensions with app
 db.init_app(app)
@@ -85,37 +372,105 @@ s = URLSafeTimedSerializer(app.config['SECRET_KEY'])
 
 # M-Pesa Service Class
 class MpesaService:
+    """Daraja API client shared by every M-Pesa call in the app.
+    
+    Keeps one pooled keep-alive session and caches the OAuth access token until
+    shortly before it expires, so an STK push costs one round-trip instead of two.
+    """
+    
     def __init__(self):
         self.consumer_key = app.config['MPESA_CONSUMER_KEY']
         self.consumer_secret = app.config['MPESA_CONSUMER_SECRET']
         self.business_shortcode = app.config['MPESA_SHORTCODE']
         self.passkey = app.config['MPESA_PASSKEY']
         self.environment = app.config['MPESA_ENVIRONMENT']
+        self.timeout = app.config['MPESA_TIMEOUT']
+        self.refresh_margin = app.config['MPESA_TOKEN_REFRESH_MARGIN']
         
         if self.environment == 'production':
             self.base_url = 'https://api.safaricom.co.ke'
         else:
             self.base_url = 'https://sandbox.safaricom.co.ke'
+        
+        # Only GETs are retried on read errors and 5xx responses; a POST is
+        # retried only when the connection failed before anything was sent,
+        # so a customer never receives two STK prompts for one checkout.
+        retry = Retry(
+            total=3,
+            connect=3,
+            read=2,
+            status=2,
+            backoff_factor=0.5,
+            status_forcelist=[500, 502, 503, 504],
+            allowed_methods=frozenset(['GET']),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=app.config['MPESA_POOL_SIZE'],
+            max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        
+        self._token = None
+        self._token_expires_at = 0
+        self._token_lock = threading.Lock()
     
     def get_access_token(self):
-        """Get M-Pesa access token"""
-        try:
-            url = f"{self.base_url}/oauth/v1/generate?grant_type=client_credentials"
-            auth_string = f"{self.consumer_key}:{self.consumer_secret}"
-            encoded_auth = base64.b64encode(auth_string.encode()).decode()
+        """Get M-Pesa access token, reusing the cached one until it is about to expire"""
+        if self._token and time.monotonic() < self._token_expires_at:
+            return self._token
+        
+        with self._token_lock:
+            # Another thread may have refreshed the token while we waited
+            if self._token and time.monotonic() < self._token_expires_at:
+                return self._token
+            
+            try:
+                url = f"{self.base_url}/oauth/v1/generate?grant_type=client_credentials"
+                response = self.session.get(
+                    url,
+                    auth=(self.consumer_key, self.consumer_secret),
+                    timeout=self.timeout
+                )
+                response.raise_for_status()
+                
+                data = response.json()
+                expires_in = int(data.get('expires_in', 3599))
+                self._token = data.get('access_token')
+                self._token_expires_at = time.monotonic() + max(expires_in - self.refresh_margin, 0)
+                return self._token
+            except Exception as e:
+                mpesa_logger.error(f"Error getting access token: {str(e)}")
+                return None
+    
+    def invalidate_access_token(self):
+        """Drop the cached access token so the next call fetches a fresh one"""
+        with self._token_lock:
+            self._token = None
+            self._token_expires_at = 0
+    
+    def post(self, path, payload):
+        """POST an authenticated JSON request to the Daraja API.
+        
+        Returns the response, or None if no access token could be obtained.
+        A 401 means Safaricom revoked the cached token early, so it is
+        refreshed and the request sent once more.
+        """
+        for attempt in range(2):
+            access_token = self.get_access_token()
+            if not access_token:
+                return None
             
             headers = {
-                'Authorization': f'Basic {encoded_auth}'
+                'Authorization': f'Bearer {access_token}',
+                'Content-Type': 'application/json'
             }
-            
-            response = requests.get(url, headers=headers, timeout=30)
-            response.raise_for_status()
-            
-            data = response.json()
-            return data.get('access_token')
-        except Exception as e:
-            app.logger.error(f"Error getting access token: {str(e)}")
-            return None
+            response = self.session.post(f"{self.base_url}{path}", json=payload, headers=headers, timeout=self.timeout)
+            if response.status_code != 401 or attempt:
+                return response
+            self.invalidate_access_token()
     
     def generate_password(self):
         """Generate Lipa Na M-Pesa Online password"""
@@ -127,10 +482,6 @@ class MpesaService:
     def stk_push(self, phone_number, amount, account_reference, description):
         """Initiate STK Push request"""
         try:
-            access_token = self.get_access_token()
-            if not access_token:
-                return {'error': 'Failed to get access token'}, 500
-            
             password, timestamp = self.generate_password()
             
             # FIXED: Better phone number formatting
@@ -167,16 +518,12 @@ class MpesaService:
                 "TransactionDesc": description
             }
             
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json'
-            }
-            
-            url = f"{self.base_url}/mpesa/stkpush/v1/processrequest"
-            response = requests.post(url, json=payload, headers=headers, timeout=30)
+            response = self.post('/mpesa/stkpush/v1/processrequest', payload)
+            if response is None:
+                return {'error': 'Failed to get access token'}, 500
             response_data = response.json()
             
-            app.logger.info(f"M-Pesa STK Push Response: {response_data}")
+            mpesa_logger.info("M-Pesa STK Push response", extra={'response': response_data})
             
             if response.status_code == 200:
                 if 'ResponseCode' in response_data and response_data['ResponseCode'] == '0':
@@ -204,12 +551,303 @@ class MpesaService:
                 }, response.status_code
                 
         except Exception as e:
-            app.logger.error(f"Error in STK Push: {str(e)}")
+            mpesa_logger.error(f"Error in STK Push: {str(e)}")
             return {'success': False, 'error': 'An unexpected error occurred'}, 500
 
 # Create global instance
 mpesa_service = MpesaService()
 
+# Background Jobs
+job_executor = ThreadPoolExecutor(max_workers=app.config['BACKGROUND_WORKERS'], thread_name_prefix='job')
+
+def _log_job_failure(future):
+    exc = future.exception()
+    if exc:
+        app.logger.error(f"Background job failed: {exc}", exc_info=exc)
+
+_image_executor = None
+_image_executor_lock = threading.Lock()
+
+def get_image_executor(broken=None):
+    """Process pool for CPU-heavy image resizing, created on first upload.
+    
+    Pass the pool that raised BrokenProcessPool as broken to shut it down
+    and get a fresh one; a worker killed by the OOM killer or a hostile
+    upload otherwise breaks the pool for the life of the process.
+    """
+    global _image_executor
+    with _image_executor_lock:
+        if broken is not None and _image_executor is broken:
+            broken.shutdown(wait=False, cancel_futures=True)
+            _image_executor = None
+        if _image_executor is None:
+            # Forking a threaded server copies its locks and pooled connections
+            # mid-use; forkserver children only import image_pipeline
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _image_executor = ProcessPoolExecutor(
+                max_workers=app.config['IMAGE_WORKERS'],
+                mp_context=multiprocessing.get_context(start_method)
+            )
+        return _image_executor
+
+def enqueue_job(func, *args, **kwargs):
+    """Run func in the background job pool inside an application context"""
+    # Jobs log under the ID of the request that queued them
+    request_id = g.get('request_id') if has_app_context() else None
+    
+    def run():
+        with app.app_context():
+            g.request_id = request_id
+            return func(*args, **kwargs)
+    
+    future = job_executor.submit(run)
+    future.add_done_callback(_log_job_failure)
+    return future
+
+# Cache
+class LocalCache:
+    """In-process LRU cache with a TTL per entry"""
+    
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+    
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+def import_redis():
+    """The redis module, imported when a Redis URL is configured"""
+    import redis  # Optional dependency, only needed for multi-worker deployments
+    return redis
+
+class RedisCache:
+    """Redis-backed cache shared by every gunicorn worker; values are stored as JSON"""
+    
+    def __init__(self, url):
+        self.client = import_redis().Redis.from_url(url)
+    
+    def get(self, key):
+        value = self.client.get(key)
+        return json.loads(value) if value is not None else None
+    
+    def set(self, key, value, ttl):
+        self.client.set(key, json.dumps(value), ex=ttl)
+    
+    def delete(self, key):
+        self.client.delete(key)
+
+if app.config['CACHE_BACKEND'] == 'redis':
+    cache = RedisCache(app.config['REDIS_URL'])
+else:
+    cache = LocalCache(app.config['CACHE_MAX_ENTRIES'])
+
+# Payment Events
+class LocalPaymentEvents:
+    """In-process pub/sub of payment state changes, keyed by order id.
+    
+    Only reaches subscribers in the same process, so it suits a single
+    gunicorn worker; the event stream re-reads the database between
+    keepalives to cover events published by other workers.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+    
+    def publish(self, order_id, data):
+        with self._lock:
+            subscribers = list(self._subscribers.get(order_id, ()))
+        for subscriber in subscribers:
+            subscriber.put(data)
+    
+    def subscribe(self, order_id):
+        subscription = LocalSubscription(self, order_id)
+        with self._lock:
+            self._subscribers.setdefault(order_id, set()).add(subscription.queue)
+        return subscription
+    
+    def unsubscribe(self, order_id, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(order_id)
+            if subscribers:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[order_id]
+
+class LocalSubscription:
+    def __init__(self, events, order_id):
+        self.events = events
+        self.order_id = order_id
+        self.queue = queue.Queue()
+    
+    def get(self, timeout):
+        """Block until an event arrives, returning None on timeout"""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+    
+    def close(self):
+        self.events.unsubscribe(self.order_id, self.queue)
+
+class RedisPaymentEvents:
+    """Redis pub/sub of payment state changes, shared by every gunicorn worker"""
+    
+    def __init__(self, url):
+        self.client = import_redis().Redis.from_url(url)
+    
+    def publish(self, order_id, data):
+        self.client.publish(f'payment:{order_id}', json.dumps(data))
+    
+    def subscribe(self, order_id):
+        return RedisSubscription(self.client, order_id)
+
+class RedisSubscription:
+    def __init__(self, client, order_id):
+        self.pubsub = client.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(f'payment:{order_id}')
+    
+    def get(self, timeout):
+        """Block until an event arrives, returning None on timeout"""
+        message = self.pubsub.get_message(timeout=timeout)
+        return json.loads(message['data']) if message else None
+    
+    def close(self):
+        self.pubsub.close()
+
+if app.config['PAYMENT_EVENTS_BACKEND'] == 'redis':
+    payment_events = RedisPaymentEvents(app.config['REDIS_URL'])
+else:
+    payment_events = LocalPaymentEvents()
+
+# Each open stream holds a gthread thread for up to PAYMENT_EVENTS_TIMEOUT
+payment_event_slots = threading.BoundedSemaphore(app.config['PAYMENT_EVENTS_MAX_STREAMS'])
+
+# Upload Storage
+# Variant files named after the sha256 of the upload they were made from
+CONTENT_ADDRESSED_FILE = re.compile(r'^[0-9a-f]{64}-\d+\.\w+$')
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+class FilesystemStorage:
+    """Keeps uploads under a local directory and serves them from the app"""
+    
+    def __init__(self, root):
+        self.root = root
+    
+    def save(self, key, source_path, content_type=None):
+        """Move a local file into storage under key"""
+        destination = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        shutil.move(source_path, destination)
+    
+    def delete(self, key):
+        path = os.path.join(self.root, key)
+        if os.path.exists(path):
+            os.remove(path)
+    
+    def exists(self, key):
+        return os.path.exists(os.path.join(self.root, key))
+    
+    def url(self, key):
+        return url_for('uploaded_file', filename=key)
+    
+    def serve(self, key, **kwargs):
+        return send_from_directory(self.root, key, **kwargs)
+
+class S3Storage:
+    """Keeps uploads in an S3-compatible bucket (AWS S3, MinIO, R2).
+    
+    Browsers download objects directly, through S3_PUBLIC_URL when set or
+    pre-signed URLs otherwise, so app workers never proxy image bytes.
+    """
+    
+    def __init__(self, bucket, endpoint_url=None, region=None, access_key_id=None,
+                 secret_access_key=None, public_url=None, url_expires=3600):
+        # Optional dependency, only needed when uploads live in object storage
+        import boto3
+        from botocore.config import Config as BotoConfig
+        
+        self.bucket = bucket
+        self.public_url = public_url.rstrip('/') if public_url else None
+        self.url_expires = url_expires
+        self.client = boto3.client(
+            's3',
+            endpoint_url=endpoint_url or None,
+            region_name=region or None,
+            aws_access_key_id=access_key_id or None,
+            aws_secret_access_key=secret_access_key or None,
+            # Path-style addressing works with self-hosted endpoints such as MinIO
+            config=BotoConfig(signature_version='s3v4', s3={'addressing_style': 'path' if endpoint_url else 'auto'})
+        )
+    
+    def save(self, key, source_path, content_type=None):
+        """Stream a local file into the bucket under key, then remove the local copy"""
+        extra_args = {'ContentType': content_type or mimetypes.guess_type(key)[0] or 'application/octet-stream'}
+        if CONTENT_ADDRESSED_FILE.match(os.path.basename(key)):
+            extra_args['CacheControl'] = IMMUTABLE_CACHE_CONTROL
+        # upload_file reads from disk in chunks and switches to multipart for large files
+        self.client.upload_file(source_path, self.bucket, key, ExtraArgs=extra_args)
+        os.remove(source_path)
+    
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+    
+    def exists(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+    
+    def url(self, key):
+        if self.public_url:
+            return f"{self.public_url}/{key}"
+        return self.client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': self.bucket, 'Key': key},
+            ExpiresIn=self.url_expires
+        )
+    
+    def serve(self, key, **kwargs):
+        return redirect(self.url(key))
+
+if app.config['STORAGE_BACKEND'] == 's3':
+    storage = S3Storage(
+        app.config['S3_BUCKET'],
+        endpoint_url=app.config['S3_ENDPOINT_URL'],
+        region=app.config['S3_REGION'],
+        access_key_id=app.config['S3_ACCESS_KEY_ID'],
+        secret_access_key=app.config['S3_SECRET_ACCESS_KEY'],
+        public_url=app.config['S3_PUBLIC_URL'],
+        url_expires=app.config['S3_URL_EXPIRES']
+    )
+else:
+    storage = FilesystemStorage(app.config['UPLOAD_FOLDER'])
+
 # Forms
 class RegistrationForm(FlaskForm):
     name = StringField('Full Name', validators=[DataRequired(), Length(min=2, max=100)])
@@ -265,6 +903,9 @@ class Product(db.Model):
     price = db.Column(db.Float, nullable=False)
     category = db.Column(db.String(50), nullable=False)
     image_url = db.Column(db.String(255), default='default-product.jpg')
+    image_manifest = db.Column(db.Text)  # JSON map of resized variants written by save_image()
+    image_hash = db.Column(db.String(64), index=True)  # StoredImage.sha256 of the current upload
+    image_error = db.Column(db.String(255))  # Why the latest upload could not be processed, if it failed
     stock = db.Column(db.Integer, default=0)
     seller_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     featured = db.Column(db.Boolean, default=False)
@@ -272,8 +913,26 @@ class Product(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    __table_args__ = (
+        # Storefront grid and search, newest first (build_catalog_query, paginate_catalog)
+        db.Index('ix_product_active_created_at', 'active', 'created_at', 'id'),
+        db.Index('ix_product_active_category_created_at', 'active', 'category', 'created_at', 'id'),
+        # Seller's own listing (my_products)
+        db.Index('ix_product_seller_id_created_at', 'seller_id', 'created_at'),
+        # Admin product list
+        db.Index('ix_product_created_at', 'created_at'),
+    )
+    
     seller = db.relationship('User', backref=db.backref('products', lazy=True))
 
+class StoredImage(db.Model):
+    """A content-addressed upload, shared by every product using the same photo"""
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), unique=True, nullable=False)
+    manifest = db.Column(db.Text, nullable=False)  # Same shape as Product.image_manifest
+    ref_count = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 class Cart(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -281,6 +940,11 @@ class Cart(db.Model):
     quantity = db.Column(db.Integer, default=1, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        # Cart page and badge by user, add_to_cart() by user and product
+        db.Index('ix_cart_user_id_product_id', 'user_id', 'product_id'),
+    )
+    
     user = db.relationship('User', backref=db.backref('cart_items', lazy=True))
     product = db.relationship('Product', backref=db.backref('in_carts', lazy=True))
 
@@ -293,20 +957,30 @@ class Order(db.Model):
     phone_number = db.Column(db.String(20), nullable=False)
     shipping_address = db.Column(db.Text)
     notes = db.Column(db.Text)
-    order_items = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    __table_args__ = (
+        # user_orders(), newest first
+        db.Index('ix_order_user_id_created_at', 'user_id', 'created_at'),
+        # Admin order list and recent orders
+        db.Index('ix_order_created_at', 'created_at'),
+        # Revenue totals over paid orders
+        db.Index('ix_order_payment_status_created_at', 'payment_status', 'created_at'),
+    )
+    
     user = db.relationship('User', backref=db.backref('orders', lazy=True))
 
 class OrderItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False)
-    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False, index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
+    # Name and unit price as they were at checkout, so later catalog edits leave past orders alone
+    product_name = db.Column(db.String(100), nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
     price = db.Column(db.Float, nullable=False)
     
-    order = db.relationship('Order', backref=db.backref('items', lazy=True))
+    order = db.relationship('Order', backref=db.backref('items', lazy=True, order_by='OrderItem.id'))
     product = db.relationship('Product', backref=db.backref('order_items', lazy=True))
 
 class PasswordReset(db.Model):
@@ -333,134 +1007,1241 @@ class MpesaPayment(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    __table_args__ = (
+        # latest_payment(): newest payment for an order
+        db.Index('ix_mpesa_payment_order_id_created_at', 'order_id', 'created_at'),
+        # Callbacks find their payment by CheckoutRequestID; named to match the f2d07efb2940 migration
+        db.Index('ix_mpesa_payment_checkout_request_id', 'checkout_request_id', unique=True),
+    )
+    
     order = db.relationship('Order', backref=db.backref('mpesa_payments', lazy=True))
 
+class MpesaCallback(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    checkout_request_id = db.Column(db.String(100), unique=True, nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), default='received', nullable=False)  # received, processing, applied or failed
+    error = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    processed_at = db.Column(db.DateTime)
+
+class StockReservation(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False, index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), default='held', nullable=False)  # held, committed or released
+    expires_at = db.Column(db.DateTime, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_stock_reservation_status_expires_at', 'status', 'expires_at'),
+    )
+
+class EmailOutbox(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(100), nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    html = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), default='pending', nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    claim_token = db.Column(db.String(32))
+    last_error = db.Column(db.String(255))
+    sent_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_email_outbox_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
+
+class SalesRollup(db.Model):
+    """Paid sales counters per day or month, for one product, one category or the whole store"""
+    id = db.Column(db.Integer, primary_key=True)
+    period = db.Column(db.String(10), nullable=False)  # day or month
+    period_start = db.Column(db.Date, nullable=False)
+    dimension = db.Column(db.String(20), nullable=False)  # product, category or total
+    dimension_key = db.Column(db.String(100), default='', nullable=False)  # Product id or category name
+    revenue = db.Column(db.Float, default=0, nullable=False)
+    units = db.Column(db.Integer, default=0, nullable=False)
+    orders = db.Column(db.Integer, default=0, nullable=False)
+    
+    __table_args__ = (
+        db.UniqueConstraint('period', 'dimension', 'dimension_key', 'period_start',
+                            name='uq_sales_rollup_period_dimension_key_start'),
+    )
+
 @login_manager.user_loader
 def load_user(user_id):
     return db.session.get(User, int(user_id))
 
-# Utility Functions
-def save_image(image_file, folder='products'):
-    """Save uploaded image and return filename"""
-    if image_file and image_file.filename:
-        random_hex = secrets.token_hex(8)
-        _, f_ext = os.path.splitext(image_file.filename)
-        filename = random_hex + f_ext.lower()
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], folder, filename)
+# Payment states after which payment_pending stops watching
+FINAL_PAYMENT_STATUSES = ('completed', 'failed', 'expired', 'refund_due')
+
+def payment_status_data(order, payment):
+    """Payment state of an order as reported to the payment_pending page"""
+    return {
+        'success': True,
+        'payment_status': payment.status,
+        'order_status': order.status,
+        'receipt_number': payment.receipt_number,
+        'message': payment.result_desc
+    }
+
+def latest_payment(order_id):
+    return MpesaPayment.query.filter_by(order_id=order_id).order_by(MpesaPayment.created_at.desc()).first()
+
+def publish_payment_status(payment):
+    """Notify payment_pending streams that a payment changed state"""
+    try:
+        payment_events.publish(payment.order_id, payment_status_data(payment.order, payment))
+    except Exception as e:
+        app.logger.error(f"Error publishing payment event: {str(e)}")
+
+# Inventory
+def _take_stock_statement():
+    product = Product.__table__
+    return product.update().where(
+        product.c.id == db.bindparam('reserve_product_id'),
+        product.c.stock >= db.bindparam('reserve_quantity')
+    ).values(stock=product.c.stock - db.bindparam('reserve_quantity'))
+
+def _take_stock(quantities):
+    """Decrement stock for {product_id: quantity} in the database, only where enough remains.
+    
+    Returns True if every product had enough stock. The caller must roll back
+    on False, since some of the rows may already have been decremented.
+    """
+    statement = _take_stock_statement()
+    params = [{'reserve_product_id': product_id, 'reserve_quantity': quantity}
+              for product_id, quantity in quantities.items()]
+    
+    if db.engine.dialect.supports_sane_multi_rowcount:
+        updated = db.session.execute(statement, params).rowcount
+    else:
+        updated = sum(db.session.execute(statement, row).rowcount for row in params)
+    # Cached grid pages only show whether a product is in stock
+    sold_out = db.session.execute(
+        db.select(Product.id).where(Product.id.in_(list(quantities)), Product.stock <= 0).limit(1)
+    ).first()
+    if sold_out:
+        invalidate_catalog()
+    return updated == len(params)
+
+def _return_stock(product_id, quantity):
+    product = Product.__table__
+    db.session.execute(
+        product.update().where(product.c.id == product_id).values(stock=product.c.stock + quantity)
+    )
+    stock = db.session.execute(db.select(Product.stock).where(Product.id == product_id)).scalar()
+    # Only a product coming back into stock changes the cached grid
+    if stock is not None and stock - quantity <= 0:
+        invalidate_catalog()
+
+def reserve_stock(order_id, quantities):
+    """Take stock for an order and hold it until its payment settles.
+    
+    The stock check and decrement happen in one conditional UPDATE, so
+    concurrent checkouts cannot oversell. Reservations not settled within
+    STOCK_RESERVATION_MINUTES are released by release_expired_reservations(),
+    which the payment sweeper runs every PAYMENT_SWEEP_INTERVAL.
+    """
+    if not _take_stock(quantities):
+        return False
+    
+    expires_at = datetime.utcnow() + timedelta(minutes=app.config['STOCK_RESERVATION_MINUTES'])
+    for product_id, quantity in quantities.items():
+        db.session.add(StockReservation(
+            order_id=order_id,
+            product_id=product_id,
+            quantity=quantity,
+            expires_at=expires_at
+        ))
+    return True
+
+def release_reservations(reservations):
+    """Return held stock to the shelf; each reservation is released at most once.
+    
+    Returns the reservations this call released.
+    """
+    released = []
+    for reservation in reservations:
+        claimed = db.session.execute(
+            db.update(StockReservation)
+            .where(StockReservation.id == reservation.id, StockReservation.status == 'held')
+            .values(status='released')
+        ).rowcount
+        if claimed:
+            _return_stock(reservation.product_id, reservation.quantity)
+            released.append(reservation)
+    return released
+
+def release_order_reservations(order_id):
+    release_reservations(StockReservation.query.filter_by(order_id=order_id, status='held').all())
+
+def release_expired_reservations():
+    """Release reservations whose payment never settled in time, and expire their orders.
+    
+    The order is cancelled and its unsettled payment marked 'expired', so a
+    payment confirmed afterwards goes to the refund path in
+    apply_stk_callback() instead of selling stock that is back on the shelf.
+    """
+    expired = StockReservation.query.filter(
+        StockReservation.status == 'held',
+        StockReservation.expires_at < datetime.utcnow()
+    ).limit(100).all()
+    if not expired:
+        return
+    
+    order_ids = {reservation.order_id for reservation in release_reservations(expired)}
+    payments = []
+    if order_ids:
+        payments = MpesaPayment.query.filter(
+            MpesaPayment.order_id.in_(order_ids),
+            MpesaPayment.status.in_(('initiating', 'pending'))
+        ).all()
+        for payment in payments:
+            payment.status = 'expired'
+            payment.result_desc = 'The payment window for this order expired.'
+        for order in Order.query.filter(Order.id.in_(order_ids), Order.payment_status == 'pending'):
+            order.payment_status = 'expired'
+            order.status = 'cancelled'
+    db.session.commit()
+    
+    for payment in payments:
+        publish_payment_status(payment)
+
+def commit_order_reservations(order_id):
+    """Make an order's reservations permanent once it is paid"""
+    db.session.execute(
+        db.update(StockReservation)
+        .where(StockReservation.order_id == order_id, StockReservation.status == 'held')
+        .values(status='committed')
+    )
+
+# Sales Rollups
+def increment_sales_rollups(rows):
+    """Add each row's revenue, units and orders to its rollup, creating it if needed"""
+    table = SalesRollup.__table__
+    dialect = db.session.get_bind(mapper=SalesRollup).dialect.name
+    
+    if dialect in ('sqlite', 'postgresql'):
+        insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+        statement = insert(table).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=['period', 'dimension', 'dimension_key', 'period_start'],
+            set_={
+                'revenue': table.c.revenue + statement.excluded.revenue,
+                'units': table.c.units + statement.excluded.units,
+                'orders': table.c.orders + statement.excluded.orders
+            }
+        )
+        db.session.execute(statement)
+        return
+    
+    for row in rows:
+        updated = db.session.execute(
+            table.update().where(
+                table.c.period == row['period'],
+                table.c.dimension == row['dimension'],
+                table.c.dimension_key == row['dimension_key'],
+                table.c.period_start == row['period_start']
+            ).values(
+                revenue=table.c.revenue + row['revenue'],
+                units=table.c.units + row['units'],
+                orders=table.c.orders + row['orders']
+            )
+        ).rowcount
+        if not updated:
+            db.session.execute(table.insert().values(**row))
+
+def record_order_sales(order):
+    """Add a newly paid order to the daily and monthly rollups, in the caller's transaction"""
+    items = db.session.query(
+        OrderItem.product_id, OrderItem.quantity, OrderItem.price, Product.category
+    ).join(Product, Product.id == OrderItem.product_id).filter(OrderItem.order_id == order.id).all()
+    
+    # (dimension, key) -> [revenue, units]; each bucket counts the order once
+    buckets = {('total', ''): [order.total_amount, 0]}
+    for product_id, quantity, price, category in items:
+        for bucket in (('product', str(product_id)), ('category', category)):
+            totals = buckets.setdefault(bucket, [0, 0])
+            totals[0] += quantity * price
+            totals[1] += quantity
+        buckets[('total', '')][1] += quantity
+    
+    day = order.created_at.date()
+    rows = [
+        {'period': period, 'period_start': start, 'dimension': dimension, 'dimension_key': key,
+         'revenue': revenue, 'units': units, 'orders': 1}
+        for period, start in (('day', day), ('month', day.replace(day=1)))
+        for (dimension, key), (revenue, units) in buckets.items()
+    ]
+    increment_sales_rollups(rows)
+
+def rebuild_sales_rollups():
+    """Recompute every rollup from paid orders, for databases that predate them"""
+    db.session.execute(SalesRollup.__table__.delete())
+    paid_orders = Order.query.filter_by(payment_status='paid').order_by(Order.id).yield_per(500)
+    for order in paid_orders:
+        record_order_sales(order)
+
+# Dashboard Stats
+@db.event.listens_for(db.session, 'after_flush')
+def note_dashboard_change(db_session, flush_context):
+    changed = [*db_session.new, *db_session.dirty, *db_session.deleted]
+    if any(isinstance(instance, (User, Product, Order)) for instance in changed):
+        db_session.info['dashboard_changed'] = True
+
+@db.event.listens_for(db.session, 'after_commit')
+def drop_dashboard_stats(db_session):
+    if db_session.info.pop('dashboard_changed', False):
+        cache.delete('dashboard-stats')
+
+def dashboard_stats():
+    """Admin dashboard KPI tiles, counted in one round-trip and cached until users, products or orders change"""
+    stats = cache.get('dashboard-stats')
+    if stats is None:
+        row = db.session.execute(db.select(
+            db.select(db.func.count(User.id)).scalar_subquery().label('total_users'),
+            db.select(db.func.count(Product.id)).where(Product.active == True).scalar_subquery().label('total_products'),
+            db.select(db.func.count(Order.id)).scalar_subquery().label('total_orders'),
+            db.select(db.func.coalesce(db.func.sum(Order.total_amount), 0)).where(
+                Order.payment_status == 'paid'
+            ).scalar_subquery().label('total_revenue')
+        )).one()
+        stats = dict(row._mapping)
+        cache.set('dashboard-stats', stats, app.config['DASHBOARD_STATS_CACHE_TTL'])
+    return stats
+
+# Cart Repository
+def load_cart_items(user_id):
+    """A user's cart rows with their products loaded in the same query"""
+    return Cart.query.options(db.joinedload(Cart.product)).filter_by(user_id=user_id).order_by(Cart.id).all()
+
+def load_cart_totals(user_id):
+    """(row count, total price) of a user's cart in one aggregate query"""
+    count, total = db.session.query(
+        db.func.count(Cart.id),
+        db.func.coalesce(db.func.sum(Product.price * Cart.quantity), 0)
+    ).join(Product, Product.id == Cart.product_id).filter(Cart.user_id == user_id).one()
+    return count, float(total)
+
+class CartSnapshot:
+    """A user's cart as seen by one request.
+    
+    Rows and totals are each loaded at most once, on first use: views that
+    list the cart load the rows with their products, while the header badge
+    and JSON endpoints only need the single aggregate query.
+    """
+    
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self._items = None
+        self._totals = None
+    
+    @property
+    def items(self):
+        if self._items is None:
+            self._items = load_cart_items(self.user_id)
+        return self._items
+    
+    @property
+    def count(self):
+        if self._items is not None:
+            return len(self._items)
+        return self._load_totals()[0]
+    
+    @property
+    def total(self):
+        if self._items is not None:
+            return sum(item.product.price * item.quantity for item in self._items)
+        return self._load_totals()[1]
+    
+    def _load_totals(self):
+        if self._totals is None:
+            self._totals = load_cart_totals(self.user_id)
+        return self._totals
+
+def get_cart_snapshot():
+    """The current user's cart snapshot for this request"""
+    if 'cart_snapshot' not in g:
+        g.cart_snapshot = CartSnapshot(current_user.id)
+    return g.cart_snapshot
+
+def invalidate_cart():
+    """Forget the current user's cached cart state after the cart changes"""
+    g.pop('cart_snapshot', None)
+    cache.delete(f'cart-count:{current_user.id}')
+
+@app.context_processor
+def inject_cart_snapshot():
+    return {'cart_snapshot': get_cart_snapshot() if current_user.is_authenticated else None}
+
+# Search Backends
+def search_tokens(search):
+    """Split a search box query into plain word tokens safe to embed in a full-text query"""
+    return re.findall(r'\w+', search.lower())
+
+class LikeSearchBackend:
+    """Fallback search scanning name, description and category with LIKE"""
+    name = 'like'
+    
+    def setup(self):
+        return True
+    
+    def available(self):
+        return True
+    
+    def rebuild(self):
+        pass
+    
+    def index_product(self, product):
+        pass
+    
+    def matches(self, search):
+        pattern = f'%{search}%'
+        return db.select(
+            Product.id.label('product_id'),
+            db.literal(0.0).label('rank')
+        ).where(db.or_(
+            Product.name.ilike(pattern),
+            Product.description.ilike(pattern),
+            Product.category.ilike(pattern)
+        )).subquery('search_matches')
+
+class Fts5SearchBackend:
+    """SQLite FTS5 index over name, description and category, ranked by bm25"""
+    name = 'fts5'
+    rebuild_statements = (
+        "DELETE FROM product_search",
+        "INSERT INTO product_search (rowid, name, description, category) "
+        "SELECT id, name, description, category FROM product WHERE active = 1"
+    )
+    
+    def setup(self):
+        """Create and fill the index on its own connection, outside any request transaction"""
+        if self.available():
+            return True
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(db.text(
+                    "CREATE VIRTUAL TABLE product_search USING fts5("
+                    "name, description, category, tokenize = 'porter unicode61')"
+                ))
+                for statement in self.rebuild_statements:
+                    connection.execute(db.text(statement))
+        except Exception as e:
+            app.logger.warning(f"FTS5 unavailable, search will use LIKE: {e}")
+            return False
+        return True
+    
+    def available(self):
+        return db.session.execute(db.text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'product_search'"
+        )).first() is not None
+    
+    def rebuild(self):
+        for statement in self.rebuild_statements:
+            db.session.execute(db.text(statement))
+    
+    def index_product(self, product):
+        """Replace the product's index row; inactive products are dropped from the index"""
+        db.session.execute(db.text("DELETE FROM product_search WHERE rowid = :id"), {'id': product.id})
+        if product.active:
+            db.session.execute(db.text(
+                "INSERT INTO product_search (rowid, name, description, category) "
+                "VALUES (:id, :name, :description, :category)"
+            ), {
+                'id': product.id,
+                'name': product.name,
+                'description': product.description,
+                'category': product.category
+            })
+    
+    def matches(self, search):
+        tokens = search_tokens(search)
+        if not tokens:
+            return None
+        # Prefix-match every word; name hits weigh most, then category, then description
+        match = ' '.join(f'"{token}"*' for token in tokens)
+        return db.text(
+            "SELECT rowid AS product_id, bm25(product_search, 10.0, 1.0, 5.0) AS rank "
+            "FROM product_search WHERE product_search MATCH :match"
+        ).bindparams(match=match).columns(
+            product_id=db.Integer, rank=db.Float
+        ).subquery('search_matches')
+
+class PostgresSearchBackend:
+    """Postgres tsvector column kept current by the database, with a GIN index"""
+    name = 'postgres'
+    
+    def setup(self):
+        """Add the generated column and its index on their own connection, outside any request transaction.
         
+        Deployed databases get both from the 4b8e2a6c0d93 migration; this
+        covers databases built by init_db() alone and is a no-op after it.
+        """
         try:
-            output_size = (800, 800)
-            i = Image.open(image_file)
-            i.thumbnail(output_size, Image.Resampling.LANCZOS)
-            
-            if i.mode in ('RGBA', 'LA'):
-                background = Image.new('RGB', i.size, (255, 255, 255))
-                background.paste(i, mask=i.split()[-1])
-                i = background
-            
-            i.save(filepath, 'JPEG' if f_ext.lower() in ['.jpg', '.jpeg'] else 'PNG')
-            return filename
+            with db.engine.begin() as connection:
+                connection.execute(db.text(
+                    "ALTER TABLE product ADD COLUMN IF NOT EXISTS search_vector tsvector "
+                    "GENERATED ALWAYS AS ("
+                    "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+                    "setweight(to_tsvector('english', coalesce(category, '')), 'B') || "
+                    "setweight(to_tsvector('english', coalesce(description, '')), 'C')"
+                    ") STORED"
+                ))
+                connection.execute(db.text(
+                    "CREATE INDEX IF NOT EXISTS ix_product_search_vector ON product USING GIN (search_vector)"
+                ))
         except Exception as e:
-            print(f"Error saving image: {e}")
+            app.logger.warning(f"tsvector search unavailable, search will use LIKE: {e}")
+            return False
+        return True
+    
+    def available(self):
+        return db.session.execute(db.text(
+            "SELECT 1 FROM information_schema.columns "
+            "WHERE table_name = 'product' AND column_name = 'search_vector'"
+        )).first() is not None
+    
+    def rebuild(self):
+        pass
+    
+    def index_product(self, product):
+        # search_vector is a generated column, so Postgres keeps it in sync on write
+        pass
+    
+    def matches(self, search):
+        tokens = search_tokens(search)
+        if not tokens:
             return None
-    return 'default-product.jpg'
+        match = ' & '.join(f'{token}:*' for token in tokens)
+        # ts_rank is higher-is-better; negate it so every backend sorts rank ascending
+        return db.text(
+            "SELECT product.id AS product_id, -ts_rank(product.search_vector, query) AS rank "
+            "FROM product, to_tsquery('english', :match) AS query "
+            "WHERE product.search_vector @@ query"
+        ).bindparams(match=match).columns(
+            product_id=db.Integer, rank=db.Float
+        ).subquery('search_matches')
+
+SEARCH_BACKENDS = {
+    'like': LikeSearchBackend,
+    'fts5': Fts5SearchBackend,
+    'postgres': PostgresSearchBackend,
+}
+
+_search_backend = None
+# While the index is missing, LIKE search is used and the index is looked
+# for again after this many seconds rather than on every request
+SEARCH_INDEX_RECHECK_SECONDS = 60
+_search_index_recheck_at = 0
+
+def configured_search_backend():
+    backend_name = app.config['SEARCH_BACKEND']
+    if backend_name == 'auto':
+        dialect = db.engine.dialect.name
+        backend_name = {'sqlite': 'fts5', 'postgresql': 'postgres'}.get(dialect, 'like')
+    return SEARCH_BACKENDS[backend_name]()
+
+def setup_search_backend():
+    """Create the configured backend's index. Run from init_db(), never during a request."""
+    global _search_backend, _search_index_recheck_at
+    configured_search_backend().setup()
+    _search_backend = None
+    _search_index_recheck_at = 0
+
+def get_search_backend():
+    """Return the configured search backend, or LIKE search if init_db() has not built its index.
+    
+    Only checks that the index exists; all DDL happens in setup_search_backend().
+    The LIKE fallback is not cached, so a worker that started before init_db()
+    picks the index up within SEARCH_INDEX_RECHECK_SECONDS.
+    """
+    global _search_backend, _search_index_recheck_at
+    if _search_backend is not None:
+        return _search_backend
+    if time.monotonic() < _search_index_recheck_at:
+        return LikeSearchBackend()
+    
+    backend = configured_search_backend()
+    if backend.available():
+        _search_backend = backend
+        return backend
+    app.logger.warning(f"{backend.name} search index missing, using LIKE search until init_db() runs")
+    _search_index_recheck_at = time.monotonic() + SEARCH_INDEX_RECHECK_SECONDS
+    return LikeSearchBackend()
 
-def get_product_image(product_name):
-    """Helper function to get product image path based on product name"""
-    image_mapping = {
-        'Turmeric Powder': 'images/Turmeric-Powder.jpg',
-        'Ashwagandha Root': 'images/Ashwagandha-Root.jpg',
-        'Ginger Powder': 'images/Ginger-Powder.jpg',
-        'Dried Mint Leaves': 'images/Dried-Mint-Leaves.jpg',
-        'Moringa Powder': 'images/Moringa-Powder.jpg',
-        'Cinnamon Sticks': 'images/Cinnamon-Sticks.jpg',
-        'Holy Basil (Tulsi)': 'images/Holy-Basil.jpg',
-        'Licorice Root': 'images/Licorice-Root.jpg',
-        'Fenugreek Seeds': 'images/Fenugreek-Seeds.jpg',
-        'Cloves': 'images/Cloves.jpg',
-        'Cardamom Pods': 'images/Cardamom-Pods.jpg',
-        'Echinacea Root': 'images/Echinacea-Root.jpg',
-        'Dandelion Root': 'images/Dandelion-Root.jpg',
-        'Burdock Root': 'images/Burdock-Root.jpg',
-        'Chamomile Flowers': 'images/Chamomile-Flowers.jpg',
-        'Peppermint Leaves': 'images/Peppermint-Leaves.jpg',
-        'Nettle Leaves': 'images/Nettle-Leaves.jpg',
-        'Sage Leaves': 'images/Sage-Leaves.jpg',
-        'Thyme Leaves': 'images/Thyme-Leaves.jpg',
-    }
+# Utility Functions
+
+def stage_upload(image_file, extension):
+    """Stream an upload to the staging folder, returning (path, sha256 hex digest)"""
+    digest = hashlib.sha256()
+    staged_path = os.path.join(app.config['UPLOAD_FOLDER'], 'tmp', secrets.token_hex(8) + extension)
+    with open(staged_path, 'wb') as staged:
+        for chunk in iter(lambda: image_file.stream.read(64 * 1024), b''):
+            digest.update(chunk)
+            staged.write(chunk)
+    return staged_path, digest.hexdigest()
+
+def save_image(image_file, product_id, folder='products'):
+    """Stage an uploaded image and generate its variants in the image process pool.
+    
+    The upload is streamed to a temp file so the request only pays for the
+    copy; decoding and resizing run in a separate process, off the GIL. The
+    product keeps its current image, or the placeholder, until
+    finish_product_image() records the variants.
+    
+    Variants are stored under the sha256 of the upload, so a photo that is
+    already stored is attached straight away without being processed again.
+    """
+    if not (image_file and image_file.filename):
+        return
+    
+    _, f_ext = os.path.splitext(image_file.filename)
+    primary_format = 'JPEG' if f_ext.lower() in ['.jpg', '.jpeg'] else 'PNG'
+    staged_path, digest = stage_upload(image_file, f_ext.lower())
+    
+    stored = StoredImage.query.filter_by(sha256=digest).first()
+    product = db.session.get(Product, product_id)
+    if stored and product and attach_product_image(product, stored):
+        os.remove(staged_path)
+        return
+    
+    folder = f"{folder}/{digest[:2]}"
+    # Variants are rendered locally, then handed to storage by finish_product_image()
+    output_dir = tempfile.mkdtemp(dir=os.path.join(app.config['UPLOAD_FOLDER'], 'tmp'))
+    args = (
+        staged_path,
+        output_dir,
+        digest,
+        primary_format,
+        app.config['IMAGE_VARIANT_WIDTHS']
+    )
     
-    image_file = image_mapping.get(product_name, 'images/placeholder.jpg')
-    return url_for('static', filename=image_file)
+    if app.config['IMAGE_WORKERS'] > 0:
+        executor = get_image_executor()
+        try:
+            future = executor.submit(render_image_variants, *args)
+        except BrokenProcessPool:
+            app.logger.warning("Image process pool is broken, starting a new one")
+            try:
+                future = get_image_executor(broken=executor).submit(render_image_variants, *args)
+            except BrokenProcessPool as e:
+                # The product is already saved; record the failure rather than fail the request
+                future = Future()
+                future.set_exception(e)
+        future.add_done_callback(
+            lambda done: enqueue_job(finish_product_image, product_id, digest, folder, staged_path, output_dir, done)
+        )
+    else:
+        future = Future()
+        try:
+            future.set_result(render_image_variants(*args))
+        except Exception as e:
+            future.set_exception(e)
+        finish_product_image(product_id, digest, folder, staged_path, output_dir, future)
 
-# M-Pesa Utility Functions
-def get_mpesa_access_token():
-    """Get M-Pesa OAuth access token"""
-    consumer_key = app.config['MPESA_CONSUMER_KEY']
-    consumer_secret = app.config['MPESA_CONSUMER_SECRET']
+def finish_product_image(product_id, digest, folder, staged_path, output_dir, future):
+    """Store the variants produced for a product's upload, record them and clean up"""
+    try:
+        primary_type, variants, filename = future.result()
+        for files in variants.values():
+            for variant in files.values():
+                storage.save(f"{folder}/{variant}", os.path.join(output_dir, variant))
+    except Exception as e:
+        app.logger.error(f"Error processing image for product {product_id}: {e}")
+        record_image_failure(product_id, e)
+        return
+    finally:
+        if os.path.exists(staged_path):
+            os.remove(staged_path)
+        shutil.rmtree(output_dir, ignore_errors=True)
+    
+    manifest = json.dumps({
+        'folder': folder,
+        'primary': primary_type,
+        'variants': variants
+    })
+    for _ in range(2):
+        product = db.session.get(Product, product_id)
+        if not product:
+            return
+        stored = StoredImage.query.filter_by(sha256=digest).first()
+        try:
+            if stored is None:
+                stored = StoredImage(sha256=digest, manifest=manifest, ref_count=0)
+                db.session.add(stored)
+                db.session.flush()
+            if attach_product_image(product, stored):
+                return
+        except IntegrityError:
+            # The same photo finished processing for another product first
+            db.session.rollback()
+    app.logger.error(f"Could not attach image {digest} to product {product_id}")
+
+def record_image_failure(product_id, error):
+    """Note on a product that its latest upload could not be processed.
     
-    if app.config['MPESA_ENVIRONMENT'] == 'sandbox':
-        url = 'https://sandbox.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials'
+    The product keeps its previous image, or the bundled one, so its card
+    never points at variants that were not written.
+    """
+    if isinstance(error, BrokenProcessPool):
+        message = 'The image worker stopped while processing this upload'
     else:
-        url = 'https://api.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials'
+        message = str(error) or type(error).__name__
+    db.session.rollback()
+    db.session.execute(
+        db.update(Product).where(Product.id == product_id).values(image_error=message[:255])
+    )
+    db.session.commit()
+
+def attach_product_image(product, stored):
+    """Point a product at a stored image and commit, moving one reference from its old image.
     
-    try:
-        response = requests.get(
-            url,
-            auth=(consumer_key, consumer_secret),
-            timeout=30
+    Returns False if the stored image was garbage collected in the meantime.
+    """
+    if product.image_hash == stored.sha256:
+        if product.image_error:
+            product.image_error = None
+            db.session.commit()
+        return True
+    
+    taken = db.session.execute(
+        db.update(StoredImage)
+        .where(StoredImage.id == stored.id)
+        .values(ref_count=StoredImage.ref_count + 1)
+    ).rowcount
+    if not taken:
+        db.session.rollback()
+        return False
+    
+    old_hash, old_manifest = product.image_hash, product.image_manifest
+    if old_hash:
+        db.session.execute(
+            db.update(StoredImage)
+            .where(StoredImage.sha256 == old_hash)
+            .values(ref_count=StoredImage.ref_count - 1)
         )
-        response.raise_for_status()
-        return response.json()['access_token']
-    except Exception as e:
-        print(f"Error getting M-Pesa access token: {e}")
+    
+    manifest = json.loads(stored.manifest)
+    primary = manifest['variants'][manifest['primary']]
+    product.image_hash = stored.sha256
+    product.image_url = primary[max(primary, key=int)]
+    product.image_manifest = stored.manifest
+    product.image_error = None
+    invalidate_catalog()
+    db.session.commit()
+    
+    if old_hash:
+        enqueue_job(collect_orphaned_images)
+    elif old_manifest:
+        # Uploads from before content addressing belong to this product alone
+        enqueue_job(remove_image_files, old_manifest)
+    return True
+
+def remove_image_files(manifest):
+    """Delete every variant file listed in an image manifest"""
+    manifest = json.loads(manifest)
+    for files in manifest['variants'].values():
+        for filename in files.values():
+            storage.delete(f"{manifest['folder']}/{filename}")
+
+def collect_orphaned_images():
+    """Delete stored images that no product references any more, with their files"""
+    orphans = StoredImage.query.filter(StoredImage.ref_count <= 0).all()
+    for stored in orphans:
+        # Conditional, so an image attached again since the query is kept
+        deleted = db.session.execute(
+            db.delete(StoredImage)
+            .where(StoredImage.id == stored.id, StoredImage.ref_count <= 0)
+        ).rowcount
+        db.session.commit()
+        if deleted:
+            remove_image_files(stored.manifest)
+    return len(orphans)
+
+# Resolved pictures are pure functions of a product's image, so they are kept
+# in process even when the shared cache is Redis
+_picture_cache = LocalCache(app.config['CACHE_MAX_ENTRIES'])
+
+def product_picture(product):
+    """Sources for a product's <picture>, resolved once per product image and cached"""
+    key = f"{product.id}:{product.image_url}:{product.name}"
+    picture = _picture_cache.get(key)
+    if picture is None:
+        picture = resolve_product_picture(product)
+        _picture_cache.set(key, picture, app.config['PRODUCT_PICTURE_CACHE_TTL'])
+    return picture
+
+def resolve_product_picture(product):
+    """Sources for a product's <picture>: srcset per format plus a fallback src.
+    
+    Products without uploaded variants fall back to the bundled image.
+    """
+    placeholder = url_for('static', filename=PLACEHOLDER_IMAGE)
+    if not product.image_manifest:
+        return {'src': get_product_image(product.name), 'srcset': '', 'sources': [], 'placeholder': placeholder}
+    
+    manifest = json.loads(product.image_manifest)
+    
+    def srcset(mime_type):
+        return ', '.join(
+            f"{storage.url(manifest['folder'] + '/' + filename)} {width}w"
+            for width, filename in sorted(manifest['variants'][mime_type].items(), key=lambda v: int(v[0]))
+        )
+    
+    primary_type = manifest['primary']
+    primary = manifest['variants'][primary_type]
+    # A mid-sized variant keeps the fallback light for browsers without srcset
+    fallback_width = min(primary, key=lambda width: abs(int(width) - 640))
+    return {
+        'src': storage.url(manifest['folder'] + '/' + primary[fallback_width]),
+        'srcset': srcset(primary_type),
+        'sources': [{'type': mime_type, 'srcset': srcset(mime_type)}
+                    for mime_type in manifest['variants'] if mime_type != primary_type],
+        'placeholder': placeholder
+    }
+
+def encode_catalog_cursor(key):
+    """Encode a catalog sort key as an opaque cursor token"""
+    payload = json.dumps([value.isoformat() if isinstance(value, datetime) else value for value in key])
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+def decode_catalog_cursor(token):
+    """Decode a cursor token back into its sort key list, or None if invalid"""
+    if not token:
         return None
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        key = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except ValueError:
+        return None
+    return key if isinstance(key, list) and len(key) == 2 else None
 
-def generate_mpesa_password():
-    """Generate M-Pesa API password"""
-    shortcode = app.config['MPESA_SHORTCODE']
-    passkey = app.config['MPESA_PASSKEY']
-    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+def build_catalog_query(category='all', search=''):
+    """Build the active-product query shared by the storefront and its JSON endpoint.
+    
+    Returns the query and, when searching, the relevance column to order by
+    (lower is more relevant).
+    """
+    query = Product.query.filter_by(active=True)
+    
+    if category != 'all':
+        query = query.filter_by(category=category)
+    
+    rank = None
+    if search:
+        matches = get_search_backend().matches(search)
+        if matches is None:
+            return query.filter(db.false()), None
+        query = query.join(matches, matches.c.product_id == Product.id)
+        rank = matches.c.rank
+    
+    return query, rank
+
+def paginate_catalog(query, cursor=None, per_page=None, rank=None):
+    """Return one keyset page of products and the cursor for the next one.
+    
+    Browsing pages by (created_at, id) descending and search results by
+    (rank, id). Seeks past the cursor position instead of using OFFSET, so
+    every page costs the same regardless of how deep into the catalog it is.
+    """
+    per_page = per_page or app.config['PRODUCTS_PER_PAGE']
+    key = decode_catalog_cursor(cursor)
+    
+    if rank is None:
+        sort_column = Product.created_at
+        order = (Product.created_at.desc(), Product.id.desc())
+    else:
+        sort_column = rank
+        order = (rank.asc(), Product.id.desc())
     
-    data = f"{shortcode}{passkey}{timestamp}"
-    password = base64.b64encode(data.encode()).decode()
-    return password, timestamp
+    if key:
+        try:
+            value = datetime.fromisoformat(key[0]) if rank is None else float(key[0])
+            product_id = int(key[1])
+        except (ValueError, TypeError):
+            value = None
+        if value is not None:
+            past_value = sort_column < value if rank is None else sort_column > value
+            query = query.filter(db.or_(
+                past_value,
+                db.and_(sort_column == value, Product.id < product_id)
+            ))
+    
+    rows = query.add_columns(sort_column).order_by(*order).limit(per_page + 1).all()
+    
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last_product, last_value = rows[-1]
+        next_cursor = encode_catalog_cursor([last_value, last_product.id])
+    
+    return [product for product, _ in rows], next_cursor
+
+def invalidate_catalog():
+    """Mark the storefront catalog as changed; cached pages are dropped once the transaction commits"""
+    db.session.info['catalog_changed'] = True
+
+@db.event.listens_for(db.session, 'after_commit')
+def bump_catalog_version(session):
+    if session.info.pop('catalog_changed', False):
+        cache.set('catalog-version', new_catalog_version(), 86400)
+
+def new_catalog_version():
+    return f"{int(time.time())}-{secrets.token_hex(4)}"
+
+def catalog_version():
+    """Current catalog version, '<unix time of the change>-<random>'; every cached page key includes it"""
+    version = cache.get('catalog-version')
+    if version is None:
+        version = new_catalog_version()
+        cache.set('catalog-version', version, 86400)
+    return version
+
+def cached_catalog_page(category='all', search='', cursor=None):
+    """Render one page of the storefront grid, reusing a cached copy while the catalog is unchanged.
+    
+    Returns {'html', 'count', 'next_cursor'}. The key covers everything the
+    cards depend on: the filters, the page, whether the visitor is logged in
+    (the add-to-cart button) and dark mode. Pages are shared between gunicorn
+    workers when CACHE_BACKEND is 'redis'.
+    
+    Only browsing is cached: unsearched pages of a known category, reached
+    by a cursor that a cached page handed out. Searches, unknown categories
+    and forged cursors are rendered fresh, so the query string cannot fill
+    the shared cache and evict cart counts and dashboard stats.
+    """
+    version = catalog_version()
+    cacheable = (not search and (category == 'all' or category in Config.CATEGORIES) and
+                 (cursor is None or cache.get(catalog_cursor_key(version, category, cursor)) is not None))
+    key_parts = [version, category, cursor, current_user.is_authenticated, bool(session.get('dark_mode'))]
+    key = 'catalog:' + hashlib.sha1(json.dumps(key_parts).encode()).hexdigest()
+    
+    page = cache.get(key) if cacheable else None
+    if cacheable:
+        catalog_logger.debug("Catalog page cache " + ('hit' if page is not None else 'miss'),
+                             extra={'category': category})
+    if page is None:
+        query, rank = build_catalog_query(category, search)
+        products, next_cursor = paginate_catalog(query, cursor, rank=rank)
+        page = {
+            'html': ''.join(render_template('products/card.html', product=product) for product in products),
+            'count': len(products),
+            'next_cursor': next_cursor
+        }
+        # A replica may not have the change behind a new version yet
+        changed_at = int(version.split('-')[0])
+        if cacheable and (not db.session.info.get('use_replica') or
+                          time.time() - changed_at > app.config['READ_YOUR_WRITES_SECONDS']):
+            cache.set(key, page, app.config['CATALOG_CACHE_TTL'])
+            if next_cursor:
+                cache.set(catalog_cursor_key(version, category, next_cursor), True, app.config['CATALOG_CACHE_TTL'])
+    return page
+
+def catalog_cursor_key(version, category, cursor):
+    """Cache key marking a cursor as handed out by a cached catalog page"""
+    return 'catalog-cursor:' + hashlib.sha1(json.dumps([version, category, cursor]).encode()).hexdigest()
+
+# Admin Tables
+ORDER_STATUSES = ['pending', 'processing', 'shipped', 'delivered', 'cancelled']
+
+# Sort options per admin table: name -> (column, descending). The first is
+# the default and is served by an index; the others sort the filtered rows.
+ADMIN_SORTS = {
+    'users': {
+        'newest': (User.id, True),
+        'oldest': (User.id, False),
+        'name': (User.name, False)
+    },
+    'products': {
+        'newest': (Product.created_at, True),
+        'oldest': (Product.created_at, False),
+        'price': (Product.price, True),
+        'stock': (Product.stock, False)
+    },
+    'orders': {
+        'newest': (Order.created_at, True),
+        'oldest': (Order.created_at, False),
+        'amount': (Order.total_amount, True)
+    }
+}
+
+def admin_sort(table):
+    """The requested sort for an admin table as (name, column, descending), falling back to the default"""
+    sorts = ADMIN_SORTS[table]
+    name = request.args.get('sort')
+    if name not in sorts:
+        name = next(iter(sorts))
+    return (name, *sorts[name])
+
+def parse_admin_date(value):
+    """Parse a YYYY-MM-DD filter value, or None if it is missing or invalid"""
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None
 
-def initiate_stk_push(phone_number, amount, order_id, description):
-    """Initiate M-Pesa STK Push payment"""
-    print(f"🚀 INITIATING STK PUSH...")
+def paginate_admin(query, model, sort_column, descending, cursor=None, per_page=None):
+    """Return one keyset page of an admin table and the cursor for the next one.
     
-    # Debug the request first
-    print(f"🔍 DEBUG: Phone: {phone_number}, Amount: {amount}, Order: {order_id}")
+    Rows are ordered by (sort_column, id) and each page seeks past the last
+    row of the previous one, so deep pages of a large order history cost the
+    same as the first.
+    """
+    per_page = per_page or app.config['ADMIN_PER_PAGE']
+    key = decode_catalog_cursor(cursor)
     
-    # FIXED: Phone number formatting
-    original_phone = phone_number
-    phone_number = ''.join(filter(str.isdigit, phone_number))
+    if key:
+        value, row_id = key
+        try:
+            if isinstance(sort_column.type, db.DateTime):
+                value = datetime.fromisoformat(value)
+            row_id = int(row_id)
+        except (ValueError, TypeError):
+            value = None
+        if value is not None:
+            if descending:
+                past_value = db.or_(sort_column < value, db.and_(sort_column == value, model.id < row_id))
+            else:
+                past_value = db.or_(sort_column > value, db.and_(sort_column == value, model.id > row_id))
+            query = query.filter(past_value)
+    
+    if descending:
+        order = (sort_column.desc(), model.id.desc())
+    else:
+        order = (sort_column.asc(), model.id.asc())
+    rows = query.order_by(*order).limit(per_page + 1).all()
+    
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_catalog_cursor([getattr(rows[-1], sort_column.key), rows[-1].id])
+    
+    return rows, next_cursor
+
+def admin_page_url(**changes):
+    """URL of the current admin table with some query arguments replaced, keeping the filters"""
+    args = request.args.to_dict()
+    args.update(changes)
+    return url_for(request.endpoint, **{key: value for key, value in args.items() if value})
+
+def product_sellers():
+    """Users who have listed a product, for the seller filters; found through the seller index"""
+    return User.query.filter(User.id.in_(db.select(Product.seller_id).distinct())).order_by(User.name).all()
+
+def order_item_counts(orders):
+    """Number of line items per order for a page of orders, in one query"""
+    counts = dict(db.session.query(OrderItem.order_id, db.func.count(OrderItem.id)).filter(
+        OrderItem.order_id.in_([order.id for order in orders])
+    ).group_by(OrderItem.order_id).all())
+    return {order.id: counts.get(order.id, 0) for order in orders}
+
+# Exports
+ORDER_EXPORT_FIELDS = ['order_id', 'created_at', 'customer_name', 'customer_email', 'status', 'payment_status',
+                       'total_amount', 'phone_number', 'shipping_address']
+ORDER_ITEM_EXPORT_FIELDS = ['product_id', 'product_name', 'quantity', 'price']
+
+def export_orders_statement(date_from, date_to):
+    """One row per order item (or per order, for orders without items), in order date order"""
+    statement = db.select(
+        Order.id.label('order_id'), Order.created_at, User.name.label('customer_name'),
+        User.email.label('customer_email'), Order.status, Order.payment_status, Order.total_amount,
+        Order.phone_number, Order.shipping_address, OrderItem.product_id, OrderItem.product_name,
+        OrderItem.quantity, OrderItem.price
+    ).outerjoin(User, User.id == Order.user_id
+    ).outerjoin(OrderItem, OrderItem.order_id == Order.id
+    ).order_by(Order.created_at, Order.id, OrderItem.id)
+    return filter_export_dates(statement, Order.created_at, date_from, date_to)
+
+def export_payments_statement(date_from, date_to):
+    statement = db.select(
+        MpesaPayment.id, MpesaPayment.order_id, MpesaPayment.created_at, MpesaPayment.merchant_request_id,
+        MpesaPayment.checkout_request_id, MpesaPayment.receipt_number, MpesaPayment.phone_number,
+        MpesaPayment.amount, MpesaPayment.status, MpesaPayment.result_code, MpesaPayment.result_desc,
+        MpesaPayment.transaction_date
+    ).order_by(MpesaPayment.id)
+    return filter_export_dates(statement, MpesaPayment.created_at, date_from, date_to)
+
+def export_products_statement(date_from, date_to):
+    statement = db.select(
+        Product.id, Product.name, Product.category, Product.price, Product.stock, Product.active,
+        Product.featured, Product.seller_id, User.email.label('seller_email'), Product.created_at,
+        Product.updated_at
+    ).outerjoin(User, User.id == Product.seller_id).order_by(Product.id)
+    return filter_export_dates(statement, Product.created_at, date_from, date_to)
+
+EXPORTS = {
+    'orders': export_orders_statement,
+    'payments': export_payments_statement,
+    'products': export_products_statement
+}
+
+def filter_export_dates(statement, column, date_from, date_to):
+    if date_from:
+        statement = statement.where(column >= date_from)
+    if date_to:
+        statement = statement.where(column < date_to + timedelta(days=1))
+    return statement
+
+def export_rows(statement):
+    """Run an export query, returning its rows as mappings fetched EXPORT_BATCH_SIZE at a time.
+    
+    Plain columns rather than model instances keep the identity map empty,
+    and yield_per uses a server-side cursor on Postgres, so memory stays flat
+    however many rows are exported.
+    """
+    return db.session.execute(statement.execution_options(yield_per=app.config['EXPORT_BATCH_SIZE'])).mappings()
+
+def nest_order_items(rows):
+    """Fold consecutive per-item order rows into one record per order with an items list"""
+    order = None
+    for row in rows:
+        if order is None or order['order_id'] != row['order_id']:
+            if order is not None:
+                yield order
+            order = {field: row[field] for field in ORDER_EXPORT_FIELDS}
+            order['items'] = []
+        if row['product_id'] is not None:
+            order['items'].append({field: row[field] for field in ORDER_ITEM_EXPORT_FIELDS})
+    if order is not None:
+        yield order
+
+def export_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+# Spreadsheets run cells starting with these as formulas
+CSV_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+def csv_value(value):
+    """An export value safe to open in a spreadsheet: formula-like text is quoted with a leading '"""
+    value = export_value(value)
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+def stream_csv(rows, chunk_size=65536):
+    """Encode rows as CSV with a header line, yielding roughly chunk_size characters at a time"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(rows.keys())
+    for row in rows:
+        writer.writerow([csv_value(value) for value in row.values()])
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def stream_ndjson(records, chunk_size=65536):
+    """Encode records as newline-delimited JSON, yielding roughly chunk_size characters at a time"""
+    lines = []
+    size = 0
+    for record in records:
+        line = json.dumps(dict(record), default=export_value) + '\n'
+        lines.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield ''.join(lines)
+            lines = []
+            size = 0
+    yield ''.join(lines)
+
+PLACEHOLDER_IMAGE = 'images/default-product.jpg'
+
+# Photos bundled in static/images for the sample catalogue
+BUNDLED_PRODUCT_IMAGES = {
+    'Turmeric Powder': 'images/Turmeric-Powder.jpg',
+    'Ashwagandha Root': 'images/Ashwagandha-Root.jpg',
+    'Ginger Powder': 'images/Ginger-Powder.jpg',
+    'Dried Mint Leaves': 'images/Dried-Mint-Leaves.jpg',
+    'Moringa Powder': 'images/Moringa-Powder.jpg',
+    'Cinnamon Sticks': 'images/Cinnamon-Sticks.jpg',
+    'Holy Basil (Tulsi)': 'images/Holy-Basil.jpg',
+    'Licorice Root': 'images/Licorice-Root.jpg',
+    'Fenugreek Seeds': 'images/Fenugreek-Seeds.jpg',
+    'Cloves': 'images/Cloves.jpg',
+    'Cardamom Pods': 'images/Cardamom-Pods.jpg',
+    'Echinacea Root': 'images/Echinacea-Root.jpg',
+    'Dandelion Root': 'images/Dandelion-Root.jpg',
+    'Burdock Root': 'images/Burdock-Root.jpg',
+    'Chamomile Flowers': 'images/Chamomile-Flowers.jpg',
+    'Peppermint Leaves': 'images/Peppermint-Leaves.jpg',
+    'Nettle Leaves': 'images/Nettle-Leaves.jpg',
+    'Sage Leaves': 'images/Sage-Leaves.jpg',
+    'Thyme Leaves': 'images/Thyme-Leaves.jpg',
+}
+
+def get_product_image(product_name):
+    """Helper function to get product image path based on product name"""
+    return url_for('static', filename=BUNDLED_PRODUCT_IMAGES.get(product_name, PLACEHOLDER_IMAGE))
+
+def build_static_manifest(static_folder):
+    """Map every file under static/ to a short fingerprint of its contents"""
+    manifest = {}
+    for root, _, files in os.walk(static_folder):
+        for name in files:
+            path = os.path.join(root, name)
+            relative = os.path.relpath(path, static_folder).replace(os.sep, '/')
+            # Uploads change at runtime and are served by uploaded_file() instead
+            if relative.startswith('uploads/'):
+                continue
+            with open(path, 'rb') as f:
+                manifest[relative] = hashlib.sha256(f.read()).hexdigest()[:12]
+    return manifest
+
+STATIC_MANIFEST = build_static_manifest(app.static_folder)
+
+@app.url_defaults
+def fingerprint_static_url(endpoint, values):
+    """Add ?v=<content hash> to static URLs so they can be cached forever"""
+    if endpoint == 'static' and values.get('filename') in STATIC_MANIFEST:
+        values.setdefault('v', STATIC_MANIFEST[values['filename']])
+
+@app.after_request
+def cache_fingerprinted_static(response):
+    if request.endpoint == 'static' and request.args.get('v'):
+        if request.args['v'] == STATIC_MANIFEST.get((request.view_args or {}).get('filename')):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = 31536000
+            response.cache_control.immutable = True
+    return response
+
+# M-Pesa Utility Functions
+def get_mpesa_access_token():
+    """Get M-Pesa OAuth access token"""
+    return mpesa_service.get_access_token()
+
+def generate_mpesa_password():
+    """Generate M-Pesa API password"""
+    return mpesa_service.generate_password()
+
+def format_mpesa_phone_number(phone_number):
+    """Normalize a Kenyan phone number to 2547XXXXXXXX, or return None if invalid"""
+    phone_number = ''.join(filter(str.isdigit, phone_number or ''))
     
     if phone_number.startswith('0') and len(phone_number) == 10:
-        phone_number = '254' + phone_number[1:]
+        return '254' + phone_number[1:]
     elif len(phone_number) == 9:
-        phone_number = '254' + phone_number
+        return '254' + phone_number
     elif phone_number.startswith('254') and len(phone_number) == 12:
-        phone_number = phone_number
-    else:
-        return None, f"Invalid phone number format: {original_phone} -> {phone_number}"
-    
-    print(f"🔍 DEBUG: Formatted Phone: {phone_number}")
-    
-    access_token = get_mpesa_access_token()
-    if not access_token:
-        print("❌ Failed to get access token")
-        return None, "Failed to get access token"
-    
-    print(f"✅ Access token obtained")
+        return phone_number
+    return None
+
+def initiate_stk_push(phone_number, amount, order_id, description):
+    """Initiate M-Pesa STK Push payment"""
+    original_phone = phone_number
+    phone_number = format_mpesa_phone_number(phone_number)
+    if not phone_number:
+        return None, f"Invalid phone number format: {original_phone}"
     
     password, timestamp = generate_mpesa_password()
     
-    if app.config['MPESA_ENVIRONMENT'] == 'sandbox':
-        url = 'https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/processrequest'
-    else:
-        url = 'https://api.safaricom.co.ke/mpesa/stkpush/v1/processrequest'
-    
     payload = {
         "BusinessShortCode": app.config['MPESA_SHORTCODE'],
         "Password": password,
@@ -475,56 +2256,197 @@ def initiate_stk_push(phone_number, amount, order_id, description):
         "TransactionDesc": description
     }
     
-    print(f"📦 Payload: {json.dumps(payload)}")
-    
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json'
-    }
+    # The password is derived from the passkey, so it never reaches the logs
+    mpesa_logger.debug("Sending STK push", extra={
+        'order_id': order_id,
+        'payload': {key: value for key, value in payload.items() if key != 'Password'}
+    })
     
     try:
-        print(f"🌐 Sending request to M-Pesa...")
-        response = requests.post(url, json=payload, headers=headers, timeout=30)
+        response = mpesa_service.post('/mpesa/stkpush/v1/processrequest', payload)
+        if response is None:
+            mpesa_logger.error("STK push failed: no access token", extra={'order_id': order_id})
+            return None, "Failed to get access token"
         response_data = response.json()
         
-        print(f"📡 Response: {json.dumps(response_data)}")
-        print(f"📊 Status Code: {response.status_code}")
-        
         if response.status_code == 200:
             if 'ResponseCode' in response_data and response_data['ResponseCode'] == '0':
-                print("✅ STK Push initiated successfully!")
-                payment = MpesaPayment(
-                    order_id=order_id,
-                    merchant_request_id=response_data.get('MerchantRequestID'),
-                    checkout_request_id=response_data.get('CheckoutRequestID'),
-                    phone_number=phone_number,
-                    amount=amount,
-                    status='pending'
-                )
-                db.session.add(payment)
-                db.session.commit()
+                mpesa_logger.info("STK push initiated", extra={
+                    'order_id': order_id,
+                    'checkout_request_id': response_data.get('CheckoutRequestID')
+                })
                 return response_data, None
             else:
                 error_msg = response_data.get('CustomerMessage', 'Payment request failed')
-                print(f"❌ STK Push failed: {error_msg}")
+                mpesa_logger.warning(f"STK push rejected: {error_msg}", extra={'order_id': order_id, 'response': response_data})
                 return None, error_msg
         else:
             error_msg = response_data.get('errorMessage', 'Unknown error')
-            print(f"❌ HTTP Error: {error_msg}")
+            mpesa_logger.warning(f"STK push HTTP {response.status_code}: {error_msg}", extra={'order_id': order_id})
             return None, error_msg
             
     except Exception as e:
-        print(f"💥 Exception: {str(e)}")
+        mpesa_logger.exception(f"STK push error: {str(e)}", extra={'order_id': order_id})
         return None, str(e)
 
+def process_stk_push(payment_id, description):
+    """Background job: send the STK push for a payment and record the outcome.
+    
+    On success the payment moves from 'initiating' to 'pending' and waits for
+    mpesa_callback(); on failure the order is marked failed and its stock
+    reservation released.
+    """
+    payment = db.session.get(MpesaPayment, payment_id)
+    if not payment or payment.status != 'initiating':
+        return
+    
+    mpesa_response, error = initiate_stk_push(
+        phone_number=payment.phone_number,
+        amount=payment.amount,
+        order_id=payment.order_id,
+        description=description
+    )
+    
+    if mpesa_response and mpesa_response.get('ResponseCode') == '0':
+        payment.merchant_request_id = mpesa_response.get('MerchantRequestID')
+        payment.checkout_request_id = mpesa_response.get('CheckoutRequestID')
+        payment.status = 'pending'
+    else:
+        payment.status = 'failed'
+        payment.result_desc = (error or 'Failed to initiate M-Pesa payment.')[:255]
+        
+        order = payment.order
+        order.payment_status = 'failed'
+        release_order_reservations(order.id)
+    
+    db.session.commit()
+    publish_payment_status(payment)
+
+# Email Outbox
+def queue_email(recipient, subject, html):
+    """Add an email to the outbox in the current transaction.
+    
+    The outbox worker sends it once the caller commits, so web requests never
+    wait on SMTP.
+    """
+    db.session.add(EmailOutbox(recipient=recipient, subject=subject, html=html))
+    db.session.info['email_queued'] = True
+
+@db.event.listens_for(db.session, 'after_commit')
+def wake_email_worker(session):
+    if session.info.pop('email_queued', False):
+        email_worker.wake()
+
+def claim_email_batch():
+    """Claim the next batch of due outbox emails for this worker.
+    
+    Rows are claimed with a conditional UPDATE so several gunicorn workers can
+    drain the outbox without sending the same email twice. Emails stuck in
+    'sending' by a worker that died are reclaimed after ten minutes.
+    """
+    now = datetime.utcnow()
+    due = db.or_(
+        db.and_(EmailOutbox.status == 'pending', EmailOutbox.next_attempt_at <= now),
+        db.and_(EmailOutbox.status == 'sending', EmailOutbox.updated_at < now - timedelta(minutes=10))
+    )
+    ids = [row.id for row in db.session.query(EmailOutbox.id).filter(due)
+           .order_by(EmailOutbox.id).limit(app.config['EMAIL_BATCH_SIZE'])]
+    if not ids:
+        return []
+    
+    claim_token = secrets.token_hex(16)
+    EmailOutbox.query.filter(EmailOutbox.id.in_(ids), due).update(
+        {'status': 'sending', 'claim_token': claim_token, 'updated_at': now},
+        synchronize_session=False
+    )
+    db.session.commit()
+    return EmailOutbox.query.filter_by(claim_token=claim_token, status='sending').all()
+
+def defer_email(email, error):
+    """Schedule a failed email for retry with exponential backoff, or give up"""
+    email.attempts += 1
+    email.last_error = str(error)[:255]
+    if email.attempts >= app.config['EMAIL_MAX_ATTEMPTS']:
+        email.status = 'failed'
+    else:
+        email.status = 'pending'
+        delay = app.config['EMAIL_RETRY_DELAY'] * 2 ** (email.attempts - 1)
+        email.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+
+def drain_email_outbox():
+    """Send every due outbox email, batch by batch, over one SMTP connection"""
+    batch = claim_email_batch()
+    if not batch:
+        return 0
+    
+    sent = 0
+    try:
+        with mail.connect() as connection:
+            while batch:
+                for email in batch:
+                    try:
+                        connection.send(Message(subject=email.subject, recipients=[email.recipient], html=email.html))
+                        email.status = 'sent'
+                        email.sent_at = datetime.utcnow()
+                        sent += 1
+                    except Exception as e:
+                        email_logger.error(f"Failed to send email {email.id}: {e}")
+                        defer_email(email, e)
+                db.session.commit()
+                batch = claim_email_batch()
+    except Exception as e:
+        email_logger.error(f"SMTP connection failed: {e}")
+        for email in batch:
+            if email.status == 'sending':
+                defer_email(email, e)
+        db.session.commit()
+    
+    return sent
+
+class EmailOutboxWorker:
+    """Background thread that drains the email outbox when woken or every EMAIL_POLL_INTERVAL"""
+    
+    def __init__(self):
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+    
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='email-outbox', daemon=True)
+                self._thread.start()
+    
+    def wake(self):
+        self.start()
+        self._wake.set()
+    
+    def _run(self):
+        while True:
+            try:
+                with app.app_context():
+                    drain_email_outbox()
+            except Exception as e:
+                email_logger.error(f"Error draining email outbox: {e}")
+            self._wake.wait(timeout=app.config['EMAIL_POLL_INTERVAL'])
+            self._wake.clear()
+
+email_worker = EmailOutboxWorker()
+
+@app.before_request
+def start_email_worker():
+    email_worker.start()
+
 def send_verification_email(user_email, token):
     """Send email verification link"""
     verify_url = url_for('verify_email', token=token, _external=True)
     
-    msg = Message(
-        subject="Verify Your Email - Herbs & Spices Store",
-        recipients=[user_email],
-        html=f"""
+    queue_email(
+        user_email,
+        "Verify Your Email - Herbs & Spices Store",
+        f"""
         <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
             <h2 style="color: #4CAF50;">Welcome to Herbs & Spices Store!</h2>
             <p>Please verify your email by clicking the button below:</p>
@@ -539,32 +2461,25 @@ def send_verification_email(user_email, token):
         </div>
         """
     )
-    try:
-        mail.send(msg)
-        return True
-    except Exception as e:
-        print(f"Failed to send verification email: {e}")
-        return False
+    return True
 
 def send_order_confirmation(order, user_email):
     """Send order confirmation email"""
-    order_items = json.loads(order.order_items)
-    
     items_html = ""
-    for item in order_items:
+    for item in order.items:
         items_html += f"""
         <tr>
-            <td>{item['product_name']}</td>
-            <td>{item['quantity']}</td>
-            <td>KSh {item['price']:.2f}</td>
-            <td>KSh {item['quantity'] * item['price']:.2f}</td>
+            <td>{item.product_name}</td>
+            <td>{item.quantity}</td>
+            <td>KSh {item.price:.2f}</td>
+            <td>KSh {item.quantity * item.price:.2f}</td>
         </tr>
         """
     
-    msg = Message(
-        subject=f"Order Confirmation - #{order.id}",
-        recipients=[user_email],
-        html=f"""
+    queue_email(
+        user_email,
+        f"Order Confirmation - #{order.id}",
+        f"""
         <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
             <h2 style="color: #4CAF50;">Order Confirmed!</h2>
             <p>Thank you for your order. Here are your order details:</p>
@@ -603,43 +2518,35 @@ def send_order_confirmation(order, user_email):
         </div>
         """
     )
-    try:
-        mail.send(msg)
-        return True
-    except Exception as e:
-        print(f"Failed to send order confirmation: {e}")
-        return False
+    return True
 
 # Make the function available to templates
 app.jinja_env.globals['get_product_image'] = get_product_image
+app.jinja_env.globals['product_picture'] = product_picture
+app.jinja_env.globals['admin_page_url'] = admin_page_url
 
 # Routes
 @app.route('/')
+@read_from_replica
 def index():
     category = request.args.get('category', 'all')
     search = request.args.get('search', '')
     
-    query = Product.query.filter_by(active=True)
-    
-    if category != 'all':
-        query = query.filter_by(category=category)
-    
-    if search:
-        query = query.filter(Product.name.ilike(f'%{search}%'))
-    
-    products = query.order_by(Product.created_at.desc()).all()
-    featured_products = Product.query.filter_by(featured=True, active=True).limit(8).all()
-    
-    print(f"DEBUG: Loading {len(products)} products from database")
-    for product in products:
-        print(f"  - {product.name} (Active: {product.active})")
-    
     return render_template('index.html', 
-                         products=products,
+                         grid=cached_catalog_page(category, search),
                          categories=Config.CATEGORIES,
                          selected_category=category,
-                         search_query=search,
-                         featured_products=featured_products)
+                         search_query=search)
+
+@app.route('/api/products')
+@read_from_replica
+def api_products():
+    """Load the next page of the storefront catalog for the "Load more" button"""
+    category = request.args.get('category', 'all')
+    search = request.args.get('search', '')
+    cursor = request.args.get('cursor')
+    
+    return jsonify(cached_catalog_page(category, search, cursor))
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -665,10 +2572,9 @@ def register():
         db.session.commit()
         
         token = s.dumps(user.email, salt='email-verify')
-        if send_verification_email(user.email, token):
-            flash('Registration successful! Please check your email to verify your account.', 'success')
-        else:
-            flash('Registration successful! But we could not send verification email. Please contact support.', 'warning')
+        send_verification_email(user.email, token)
+        db.session.commit()
+        flash('Registration successful! Please check your email to verify your account.', 'success')
         
         return redirect(url_for('login'))
     
@@ -729,31 +2635,27 @@ def forgot_password():
             token = s.dumps(user.email, salt='password-reset-salt')
             reset_url = url_for('reset_password', token=token, _external=True)
             
-            try:
-                msg = Message(
-                    'Password Reset Request - Herbs & Spices Store',
-                    recipients=[user.email],
-                    html=f"""
-                    <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
-                        <h2 style="color: #4CAF50;">Password Reset Request</h2>
-                        <p>You requested to reset your password. Click the button below to create a new password:</p>
-                        <a href="{reset_url}" style="background-color: #4CAF50; color: white; padding: 12px 24px; text-decoration: none; border-radius: 5px; display: inline-block;">
-                            Reset Password
-                        </a>
-                        <p style="margin-top: 20px; color: #666;">
-                            If the button doesn't work, copy and paste this link in your browser:<br>
-                            {reset_url}
-                        </p>
-                        <p>This link will expire in 1 hour.</p>
-                        <p>If you didn't request this reset, please ignore this email.</p>
-                    </div>
-                    """
-                )
-                mail.send(msg)
-                flash('Password reset instructions have been sent to your email.', 'info')
-            except Exception as e:
-                flash('Error sending email. Please try again later.', 'danger')
-                print(f"Email error: {e}")
+            queue_email(
+                user.email,
+                'Password Reset Request - Herbs & Spices Store',
+                f"""
+                <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
+                    <h2 style="color: #4CAF50;">Password Reset Request</h2>
+                    <p>You requested to reset your password. Click the button below to create a new password:</p>
+                    <a href="{reset_url}" style="background-color: #4CAF50; color: white; padding: 12px 24px; text-decoration: none; border-radius: 5px; display: inline-block;">
+                        Reset Password
+                    </a>
+                    <p style="margin-top: 20px; color: #666;">
+                        If the button doesn't work, copy and paste this link in your browser:<br>
+                        {reset_url}
+                    </p>
+                    <p>This link will expire in 1 hour.</p>
+                    <p>If you didn't request this reset, please ignore this email.</p>
+                </div>
+                """
+            )
+            db.session.commit()
+            flash('Password reset instructions have been sent to your email.', 'info')
         else:
             flash('If that email exists in our system, reset instructions will be sent.', 'info')
         
@@ -809,6 +2711,7 @@ def logout():
     return redirect(url_for('index'))
 
 @app.route('/products/<int:product_id>')
+@read_from_replica
 def product_detail(product_id):
     product = Product.query.get_or_404(product_id)
     if not product.active:
@@ -848,16 +2751,16 @@ def add_to_cart(product_id):
         flash(f'{product.name} added to cart!', 'success')
     
     db.session.commit()
+    invalidate_cart()
     return redirect(request.referrer or url_for('index'))
 
 @app.route('/cart')
 @login_required
 def cart():
-    cart_items = Cart.query.filter_by(user_id=current_user.id).all()
-    total = sum(item.product.price * item.quantity for item in cart_items)
-    
-    for item in cart_items:
+    changed = False
+    for item in get_cart_snapshot().items:
         if item.quantity > item.product.stock:
+            changed = True
             if item.product.stock == 0:
                 db.session.delete(item)
                 flash(f'{item.product.name} is out of stock and has been removed from your cart.', 'warning')
@@ -865,17 +2768,17 @@ def cart():
                 item.quantity = item.product.stock
                 flash(f'Updated {item.product.name} quantity to available stock ({item.product.stock}).', 'warning')
     
-    db.session.commit()
-    
-    cart_items = Cart.query.filter_by(user_id=current_user.id).all()
-    total = sum(item.product.price * item.quantity for item in cart_items)
+    if changed:
+        db.session.commit()
+        invalidate_cart()
     
-    return render_template('cart.html', cart_items=cart_items, total=total)
+    cart_snapshot = get_cart_snapshot()
+    return render_template('cart.html', cart_items=cart_snapshot.items, total=cart_snapshot.total)
 
 @app.route('/update-cart/<int:cart_id>', methods=['POST'])
 @login_required
 def update_cart(cart_id):
-    cart_item = Cart.query.get_or_404(cart_id)
+    cart_item = Cart.query.options(db.joinedload(Cart.product)).filter_by(id=cart_id).first_or_404()
     
     if cart_item.user_id != current_user.id:
         return jsonify({'success': False, 'message': 'Unauthorized'})
@@ -891,25 +2794,24 @@ def update_cart(cart_id):
     else:
         return jsonify({'success': False, 'message': f'Only {cart_item.product.stock} available.'})
     
+    item_total = cart_item.product.price * quantity if quantity > 0 else 0
     db.session.commit()
+    invalidate_cart()
     
-    cart_items = Cart.query.filter_by(user_id=current_user.id).all()
-    total = sum(item.product.price * item.quantity for item in cart_items)
-    item_total = cart_item.product.price * cart_item.quantity if quantity > 0 else 0
-    
+    cart_snapshot = get_cart_snapshot()
     return jsonify({
         'success': True,
         'message': message,
         'item_total': item_total,
-        'cart_total': total,
-        'cart_count': len(cart_items)
+        'cart_total': cart_snapshot.total,
+        'cart_count': cart_snapshot.count
     })
 
 # ADDED: Remove from cart function
 @app.route('/remove-from-cart/<int:cart_id>')
 @login_required
 def remove_from_cart(cart_id):
-    cart_item = Cart.query.get_or_404(cart_id)
+    cart_item = Cart.query.options(db.joinedload(Cart.product)).filter_by(id=cart_id).first_or_404()
     
     if cart_item.user_id != current_user.id:
         flash('Unauthorized action.', 'danger')
@@ -918,13 +2820,17 @@ def remove_from_cart(cart_id):
     product_name = cart_item.product.name
     db.session.delete(cart_item)
     db.session.commit()
+    invalidate_cart()
     flash(f'{product_name} removed from cart.', 'success')
     return redirect(url_for('cart'))
 
 @app.route('/checkout', methods=['GET', 'POST'])
 @login_required
 def checkout():
-    cart_items = Cart.query.filter_by(user_id=current_user.id).all()
+    # The payment sweeper releases these on a timer; this is a backstop
+    release_expired_reservations()
+    cart_snapshot = get_cart_snapshot()
+    cart_items = cart_snapshot.items
     
     if not cart_items:
         flash('Your cart is empty.', 'warning')
@@ -935,18 +2841,14 @@ def checkout():
             flash(f'Only {item.product.stock} {item.product.name} available. Please update your cart.', 'danger')
             return redirect(url_for('cart'))
     
-    total = sum(item.product.price * item.quantity for item in cart_items)
+    total = cart_snapshot.total
     form = CheckoutForm()
     
     if form.validate_on_submit():
-        order_items = []
-        for item in cart_items:
-            order_items.append({
-                'product_id': item.product_id,
-                'product_name': item.product.name,
-                'quantity': item.quantity,
-                'price': float(item.product.price)
-            })
+        phone_number = format_mpesa_phone_number(form.phone_number.data)
+        if not phone_number:
+            flash('Payment Error: Invalid phone number format. Please use format: 0712345678 or 254712345678', 'danger')
+            return render_template('checkout.html', form=form, cart_items=cart_items, total=total)
         
         order = Order(
             user_id=current_user.id,
@@ -954,44 +2856,49 @@ def checkout():
             phone_number=form.phone_number.data,
             shipping_address=form.shipping_address.data,
             notes=form.notes.data,
-            order_items=json.dumps(order_items),
             payment_status='pending'
         )
         
         db.session.add(order)
         db.session.flush()
         
-        description = f"Herbs & Spices Order #{order.id}"
-        mpesa_response, error = initiate_stk_push(
-            phone_number=form.phone_number.data,
-            amount=total,
+        quantities = {}
+        for item in cart_items:
+            quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+        
+        if not reserve_stock(order.id, quantities):
+            db.session.rollback()
+            flash('Some items in your cart just sold out. Please review your cart.', 'danger')
+            return redirect(url_for('cart'))
+        
+        for item in cart_items:
+            order_item = OrderItem(
+                order_id=order.id,
+                product_id=item.product_id,
+                product_name=item.product.name,
+                quantity=item.quantity,
+                price=item.product.price
+            )
+            db.session.add(order_item)
+        
+        payment = MpesaPayment(
             order_id=order.id,
-            description=description
+            phone_number=phone_number,
+            amount=total,
+            status='initiating'
         )
+        db.session.add(payment)
         
-        if mpesa_response and mpesa_response.get('ResponseCode') == '0':
-            for item in cart_items:
-                product = Product.query.get(item.product_id)
-                product.stock -= item.quantity
-                
-                order_item = OrderItem(
-                    order_id=order.id,
-                    product_id=item.product_id,
-                    quantity=item.quantity,
-                    price=item.product.price
-                )
-                db.session.add(order_item)
-            
-            Cart.query.filter_by(user_id=current_user.id).delete()
-            db.session.commit()
-            
-            flash('M-Pesa payment request sent to your phone. Please complete the payment to confirm your order.', 'info')
-            return redirect(url_for('payment_pending', order_id=order.id))
-        else:
-            db.session.rollback()
-            error_msg = error or 'Failed to initiate M-Pesa payment. Please try again.'
-            flash(f'Payment Error: {error_msg}', 'danger')
-            return render_template('checkout.html', form=form, cart_items=cart_items, total=total)
+        Cart.query.filter_by(user_id=current_user.id).delete()
+        db.session.commit()
+        invalidate_cart()
+        
+        # Safaricom can take tens of seconds to answer, so the STK push runs in
+        # the background and payment_pending polls for the outcome
+        enqueue_job(process_stk_push, payment.id, f"Herbs & Spices Order #{order.id}")
+        
+        flash('Sending an M-Pesa payment request to your phone. Please complete the payment to confirm your order.', 'info')
+        return redirect(url_for('payment_pending', order_id=order.id))
     
     return render_template('checkout.html', form=form, cart_items=cart_items, total=total)
 
@@ -1005,57 +2912,251 @@ def payment_pending(order_id):
     
     return render_template('payment_pending.html', order=order)
 
+def apply_stk_callback(stk_callback):
+    """Apply a Daraja stkCallback to its payment and order without committing.
+    
+    Returns (result_code, result_desc, payment). A payment that has already
+    settled is left untouched. A payment that succeeds after its order
+    expired is recorded as 'refund_due' and reported to ADMIN_ALERT_EMAIL,
+    because its stock has already gone back on sale.
+    """
+    checkout_request_id = stk_callback.get('CheckoutRequestID')
+    result_code = stk_callback.get('ResultCode')
+    result_desc = stk_callback.get('ResultDesc')
+    
+    payment = MpesaPayment.query.filter_by(checkout_request_id=checkout_request_id).first()
+    if not payment:
+        return 1, 'Payment not found', None
+    
+    if payment.status in ('completed', 'failed', 'refund_due'):
+        return 0, 'Payment already settled', payment
+    
+    expired = payment.status == 'expired'
+    payment.result_code = result_code
+    payment.result_desc = result_desc
+    
+    if result_code == 0:
+        payment.status = 'completed'
+        payment.transaction_date = datetime.utcnow()
+        
+        callback_items = stk_callback.get('CallbackMetadata', {}).get('Item', [])
+        for item in callback_items:
+            if item.get('Name') == 'MpesaReceiptNumber':
+                payment.receipt_number = item.get('Value')
+            elif item.get('Name') == 'TransactionDate':
+                trans_date = str(item.get('Value'))
+                if trans_date:
+                    payment.transaction_date = datetime.strptime(trans_date, '%Y%m%d%H%M%S')
+        
+        if expired:
+            flag_payment_for_refund(payment)
+            return 0, 'Success', payment
+        
+        order = payment.order
+        if order.payment_status != 'paid':
+            record_order_sales(order)
+        order.payment_status = 'paid'
+        order.status = 'processing'
+        commit_order_reservations(order.id)
+        
+        send_order_confirmation(order, order.user.email)
+        
+    elif expired:
+        # The order was already cancelled and its stock released
+        payment.status = 'failed'
+    else:
+        payment.status = 'failed'
+        order = payment.order
+        order.payment_status = 'failed'
+        release_order_reservations(order.id)
+    
+    return 0, 'Success', payment
+
+def flag_payment_for_refund(payment):
+    """Record a payment that arrived after its order expired, and ask an admin to refund it"""
+    order = payment.order
+    payment.status = 'refund_due'
+    payment.result_desc = 'Payment received after the order expired. It will be refunded.'
+    order.payment_status = 'refund_due'
+    mpesa_logger.error("Payment received for an expired order; refund required",
+                       extra={'order_id': order.id, 'receipt_number': payment.receipt_number,
+                              'amount': payment.amount})
+    queue_email(
+        app.config['ADMIN_ALERT_EMAIL'],
+        f"Refund required - Order #{order.id}",
+        f"""
+        <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
+            <h2 style="color: #c0392b;">Refund Required</h2>
+            <p>M-Pesa payment {payment.receipt_number or ''} of KSh {payment.amount:.2f} from
+            {payment.phone_number} arrived after order #{order.id} expired and its stock was released.</p>
+            <p>Please refund the customer.</p>
+        </div>
+        """
+    )
+
+def apply_mpesa_callback(callback_id):
+    """Apply a recorded callback exactly once.
+    
+    The ledger row is claimed with a conditional UPDATE, and its outcome is
+    committed in the same transaction as the payment and order changes.
+    """
+    claimed = db.session.execute(
+        db.update(MpesaCallback)
+        .where(MpesaCallback.id == callback_id, MpesaCallback.status == 'received')
+        .values(status='processing')
+    ).rowcount
+    db.session.commit()
+    if not claimed:
+        return 0, 'Callback already processed'
+    
+    callback = db.session.get(MpesaCallback, callback_id)
+    try:
+        data = json.loads(callback.payload)
+        result_code, result_desc, payment = apply_stk_callback(data.get('Body', {}).get('stkCallback', {}))
+        callback.status = 'applied' if result_code == 0 else 'failed'
+        callback.error = None if result_code == 0 else result_desc
+        callback.processed_at = datetime.utcnow()
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        callback = db.session.get(MpesaCallback, callback_id)
+        callback.status = 'failed'
+        callback.error = str(e)[:255]
+        callback.processed_at = datetime.utcnow()
+        db.session.commit()
+        raise
+    
+    if payment:
+        publish_payment_status(payment)
+    return result_code, result_desc
+
+def requeue_mpesa_callback(callback_id, from_status, payload=None):
+    """Move a callback from from_status back to 'received' so it is applied again.
+    
+    Returns False if another worker changed its status first.
+    """
+    values = {'status': 'received', 'error': None}
+    if payload is not None:
+        values['payload'] = payload
+    requeued = db.session.execute(
+        db.update(MpesaCallback)
+        .where(MpesaCallback.id == callback_id, MpesaCallback.status == from_status)
+        .values(**values)
+    ).rowcount
+    db.session.commit()
+    return bool(requeued)
+
+def process_mpesa_callback(callback_id):
+    """Background job: apply a fast-acked callback"""
+    apply_mpesa_callback(callback_id)
+
+def sweep_mpesa_callbacks():
+    """Apply callbacks that were left behind.
+    
+    Picks up callbacks a dead worker left 'received' or 'processing', and
+    retries 'failed' ones for MPESA_CALLBACK_RETRY_MINUTES. A failure is
+    usually a callback that arrived before process_stk_push() recorded its
+    CheckoutRequestID. Runs on the payment sweeper's timer, so a retry does
+    not wait for the next callback to arrive.
+    """
+    now = datetime.utcnow()
+    stale = MpesaCallback.query.filter(
+        db.or_(
+            db.and_(MpesaCallback.status == 'received', MpesaCallback.created_at < now - timedelta(minutes=1)),
+            db.and_(MpesaCallback.status == 'processing', MpesaCallback.created_at < now - timedelta(minutes=10)),
+            db.and_(MpesaCallback.status == 'failed',
+                    MpesaCallback.processed_at < now - timedelta(minutes=1),
+                    MpesaCallback.created_at > now - timedelta(minutes=app.config['MPESA_CALLBACK_RETRY_MINUTES']))
+        )
+    ).limit(50).all()
+    for callback in stale:
+        if callback.status != 'received' and not requeue_mpesa_callback(callback.id, callback.status):
+            continue
+        try:
+            apply_mpesa_callback(callback.id)
+        except Exception as e:
+            mpesa_logger.error(f"Retrying M-Pesa callback {callback.id} failed: {e}")
+
+def sweep_payments():
+    """Periodic payment housekeeping, run by every worker's PaymentSweeper"""
+    sweep_mpesa_callbacks()
+    release_expired_reservations()
+
+class PaymentSweeper:
+    """Background thread that runs sweep_payments() every PAYMENT_SWEEP_INTERVAL"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+    
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='payment-sweeper', daemon=True)
+                self._thread.start()
+    
+    def _run(self):
+        while True:
+            time.sleep(app.config['PAYMENT_SWEEP_INTERVAL'])
+            try:
+                with app.app_context():
+                    sweep_payments()
+            except Exception as e:
+                mpesa_logger.error(f"Error sweeping payments: {e}")
+
+payment_sweeper = PaymentSweeper()
+
+@app.before_request
+def start_payment_sweeper():
+    payment_sweeper.start()
+
 @app.route('/mpesa-callback', methods=['POST'])
 def mpesa_callback():
-    """Handle M-Pesa payment callback"""
+    """Handle M-Pesa payment callback.
+    
+    Daraja retries callbacks, so each one is first recorded in the
+    MpesaCallback ledger under its CheckoutRequestID; a repeat hits the unique
+    index. It is acknowledged without being applied again unless the first
+    attempt failed, in which case the retry is applied. With
+    MPESA_CALLBACK_FAST_ACK the callback is acknowledged as soon as it is
+    recorded and applied by a background job.
+    """
     try:
         data = request.get_json()
         
         if not data:
             return jsonify({'ResultCode': 1, 'ResultDesc': 'Invalid data'})
         
-        callback_metadata = data.get('Body', {}).get('stkCallback', {})
-        checkout_request_id = callback_metadata.get('CheckoutRequestID')
-        result_code = callback_metadata.get('ResultCode')
-        result_desc = callback_metadata.get('ResultDesc')
-        
-        payment = MpesaPayment.query.filter_by(checkout_request_id=checkout_request_id).first()
-        if not payment:
-            return jsonify({'ResultCode': 1, 'ResultDesc': 'Payment not found'})
-        
-        payment.result_code = result_code
-        payment.result_desc = result_desc
+        checkout_request_id = data.get('Body', {}).get('stkCallback', {}).get('CheckoutRequestID')
+        if not checkout_request_id:
+            return jsonify({'ResultCode': 1, 'ResultDesc': 'Invalid data'})
         
-        if result_code == 0:
-            payment.status = 'completed'
-            payment.transaction_date = datetime.utcnow()
-            
-            callback_items = callback_metadata.get('CallbackMetadata', {}).get('Item', [])
-            for item in callback_items:
-                if item.get('Name') == 'MpesaReceiptNumber':
-                    payment.receipt_number = item.get('Value')
-                elif item.get('Name') == 'TransactionDate':
-                    trans_date = str(item.get('Value'))
-                    if trans_date:
-                        payment.transaction_date = datetime.strptime(trans_date, '%Y%m%d%H%M%S')
-            
-            order = payment.order
-            order.payment_status = 'paid'
-            order.status = 'processing'
-            
-            send_order_confirmation(order, order.user.email)
-            
-        else:
-            payment.status = 'failed'
-            order = payment.order
-            order.payment_status = 'failed'
+        payload = json.dumps(data)
+        callback = MpesaCallback(checkout_request_id=checkout_request_id, payload=payload)
+        db.session.add(callback)
+        try:
+            db.session.commit()
+            callback_id = callback.id
+        except IntegrityError:
+            db.session.rollback()
+            existing = MpesaCallback.query.filter_by(checkout_request_id=checkout_request_id).first()
+            # Only a failed first attempt is retried; applied or in-flight callbacks are duplicates
+            if not (existing and existing.status == 'failed' and
+                    requeue_mpesa_callback(existing.id, 'failed', payload)):
+                return jsonify({'ResultCode': 0, 'ResultDesc': 'Duplicate callback ignored'})
+            callback_id = existing.id
         
-        db.session.commit()
+        if app.config['MPESA_CALLBACK_FAST_ACK']:
+            enqueue_job(process_mpesa_callback, callback_id)
+            return jsonify({'ResultCode': 0, 'ResultDesc': 'Accepted'})
         
-        return jsonify({'ResultCode': 0, 'ResultDesc': 'Success'})
+        result_code, result_desc = apply_mpesa_callback(callback_id)
+        return jsonify({'ResultCode': result_code, 'ResultDesc': result_desc})
         
     except Exception as e:
-        print(f"Error processing M-Pesa callback: {e}")
+        mpesa_logger.exception(f"Error processing M-Pesa callback: {e}")
         return jsonify({'ResultCode': 1, 'ResultDesc': 'Error processing callback'})
 
 @app.route('/check-payment-status/<int:order_id>')
@@ -1066,17 +3167,78 @@ def check_payment_status(order_id):
     if order.user_id != current_user.id:
         return jsonify({'success': False, 'message': 'Unauthorized'})
     
-    payment = MpesaPayment.query.filter_by(order_id=order_id).order_by(MpesaPayment.created_at.desc()).first()
+    payment = latest_payment(order_id)
     
     if not payment:
         return jsonify({'success': False, 'message': 'No payment record found'})
     
-    return jsonify({
-        'success': True,
-        'payment_status': payment.status,
-        'order_status': order.status,
-        'receipt_number': payment.receipt_number
+    return jsonify(payment_status_data(order, payment))
+
+@app.route('/payment-events/<int:order_id>')
+@login_required
+def payment_events_stream(order_id):
+    """Stream payment state changes to payment_pending as Server-Sent Events.
+    
+    Sends the current state, then blocks until mpesa_callback() or the STK
+    push job publishes a change, closing once the payment completes or fails.
+    The stream is capped at PAYMENT_EVENTS_TIMEOUT; EventSource reconnects.
+    
+    A stream occupies a worker thread while open, so each worker serves at
+    most PAYMENT_EVENTS_MAX_STREAMS at once. Past that it answers 503, and
+    payment_pending falls back to polling check_payment_status().
+    """
+    order = Order.query.get_or_404(order_id)
+    if order.user_id != current_user.id:
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 403
+    
+    if not payment_event_slots.acquire(blocking=False):
+        return jsonify({'success': False, 'message': 'Too many open payment streams'}), 503, {'Retry-After': '5'}
+    
+    try:
+        # Subscribe before reading the current state so no change slips between the two
+        subscription = payment_events.subscribe(order_id)
+        payment = latest_payment(order_id)
+        initial = payment_status_data(order, payment) if payment else None
+    except Exception:
+        payment_event_slots.release()
+        raise
+    
+    keepalive = app.config['PAYMENT_EVENTS_KEEPALIVE']
+    deadline = time.monotonic() + app.config['PAYMENT_EVENTS_TIMEOUT']
+    
+    def generate():
+        yield 'retry: 3000\n\n'
+        data = initial
+        last_status = None
+        while True:
+            if data:
+                last_status = data['payment_status']
+                yield f'data: {json.dumps(data)}\n\n'
+                if last_status in FINAL_PAYMENT_STATUSES:
+                    return
+            if time.monotonic() >= deadline:
+                return
+            
+            data = subscription.get(timeout=keepalive)
+            if data is None:
+                # Catch changes published by another worker's local event bus
+                with app.app_context():
+                    current = latest_payment(order_id)
+                    if current and current.status != last_status:
+                        data = payment_status_data(current.order, current)
+                yield ': keepalive\n\n'
+    
+    def close_stream():
+        subscription.close()
+        payment_event_slots.release()
+    
+    response = Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
     })
+    # Runs when the server closes the response, even if the client left before the first event
+    response.call_on_close(close_stream)
+    return response
 
 @app.route('/order-confirmation/<int:order_id>')
 @login_required
@@ -1087,13 +3249,15 @@ def order_confirmation(order_id):
         flash('Unauthorized access.', 'danger')
         return redirect(url_for('index'))
     
-    order_items = json.loads(order.order_items)
-    return render_template('order_confirmation.html', order=order, order_items=order_items)
+    return render_template('order_confirmation.html', order=order)
 
 @app.route('/orders')
 @login_required
 def user_orders():
-    orders = Order.query.filter_by(user_id=current_user.id).order_by(Order.created_at.desc()).all()
+    # Items and their products load in one query each for the whole list
+    orders = Order.query.options(
+        db.selectinload(Order.items).selectinload(OrderItem.product)
+    ).filter_by(user_id=current_user.id).order_by(Order.created_at.desc()).all()
     return render_template('orders.html', orders=orders)
 
 @app.route('/sell', methods=['GET', 'POST'])
@@ -1107,21 +3271,25 @@ def sell():
     form = ProductForm()
     
     if form.validate_on_submit():
-        image_filename = save_image(form.image.data) if form.image.data else 'default-product.jpg'
-        
         product = Product(
             name=form.name.data,
             description=form.description.data,
             price=float(form.price.data),
             category=form.category.data,
             stock=form.stock.data,
-            image_url=image_filename,
+            image_url='default-product.jpg',
             seller_id=current_user.id
         )
         
         db.session.add(product)
+        db.session.flush()
+        get_search_backend().index_product(product)
+        invalidate_catalog()
         db.session.commit()
         
+        if form.image.data:
+            save_image(form.image.data, product.id)
+        
         flash('Product listed successfully!', 'success')
         return redirect(url_for('product_detail', product_id=product.id))
     
@@ -1155,10 +3323,12 @@ def edit_product(product_id):
         product.category = form.category.data
         product.stock = form.stock.data
         
-        if form.image.data:
-            product.image_url = save_image(form.image.data)
-        
+        get_search_backend().index_product(product)
+        invalidate_catalog()
         db.session.commit()
+        
+        if form.image.data:
+            save_image(form.image.data, product.id)
         flash('Product updated successfully!', 'success')
         return redirect(url_for('product_detail', product_id=product.id))
     
@@ -1167,28 +3337,19 @@ def edit_product(product_id):
 # Admin Routes
 @app.route('/admin/dashboard')
 @login_required
+@read_from_replica
 def admin_dashboard():
     if not current_user.is_admin:
         flash('Unauthorized access.', 'danger')
         return redirect(url_for('index'))
     
-    total_users = User.query.count()
-    total_products = Product.query.filter_by(active=True).count()
-    total_orders = Order.query.count()
-    total_revenue = db.session.query(db.func.sum(Order.total_amount)).filter(Order.payment_status == 'paid').scalar() or 0
-    
-    recent_orders = Order.query.order_by(Order.created_at.desc()).limit(5).all()
-    recent_users = User.query.order_by(User.created_at.desc()).limit(5).all()
-    low_stock = Product.query.filter(Product.stock < 10, Product.active == True).limit(5).all()
+    recent_orders = Order.query.options(db.joinedload(Order.user)).order_by(Order.created_at.desc()).limit(5).all()
+    low_stock_products = Product.query.filter(Product.stock < 10, Product.active == True).limit(5).all()
     
     return render_template('admin/dashboard.html',
-                         total_users=total_users,
-                         total_products=total_products,
-                         total_orders=total_orders,
-                         total_revenue=total_revenue,
+                         **dashboard_stats(),
                          recent_orders=recent_orders,
-                         recent_users=recent_users,
-                         low_stock=low_stock)
+                         low_stock_products=low_stock_products)
 
 @app.route('/admin/users')
 @login_required
@@ -1197,8 +3358,28 @@ def admin_users():
         flash('Unauthorized access.', 'danger')
         return redirect(url_for('index'))
     
-    users = User.query.order_by(User.created_at.desc()).all()
-    return render_template('admin/users.html', users=users)
+    query = User.query
+    role = request.args.get('role', '')
+    if role == 'admin':
+        query = query.filter(User.is_admin == True)
+    elif role == 'seller':
+        query = query.filter(User.is_seller == True)
+    elif role == 'customer':
+        query = query.filter(User.is_admin == False, User.is_seller == False)
+    
+    verified = request.args.get('verified', '')
+    if verified in ('yes', 'no'):
+        query = query.filter(User.verified == (verified == 'yes'))
+    
+    search = request.args.get('search', '').strip()
+    if search:
+        pattern = f"%{search}%"
+        query = query.filter(db.or_(User.name.ilike(pattern), User.email.ilike(pattern), User.phone.ilike(pattern)))
+    
+    sort, sort_column, descending = admin_sort('users')
+    users, next_cursor = paginate_admin(query, User, sort_column, descending, request.args.get('cursor'))
+    return render_template('admin/users.html', users=users, next_cursor=next_cursor,
+                         sorts=ADMIN_SORTS['users'], sort=sort, role=role, verified=verified, search=search)
 
 @app.route('/admin/products')
 @login_required
@@ -1207,8 +3388,60 @@ def admin_products():
         flash('Unauthorized access.', 'danger')
         return redirect(url_for('index'))
     
-    products = Product.query.order_by(Product.created_at.desc()).all()
-    return render_template('admin/products.html', products=products)
+    query = Product.query.options(db.joinedload(Product.seller))
+    category = request.args.get('category', '')
+    if category in Config.CATEGORIES:
+        query = query.filter(Product.category == category)
+    
+    seller_id = request.args.get('seller', type=int)
+    if seller_id:
+        query = query.filter(Product.seller_id == seller_id)
+    
+    status = request.args.get('status', '')
+    if status == 'active':
+        query = query.filter(Product.active == True)
+    elif status == 'inactive':
+        query = query.filter(Product.active == False)
+    elif status == 'low_stock':
+        query = query.filter(Product.stock < 10)
+    
+    search = request.args.get('search', '').strip()
+    if search:
+        query = query.filter(Product.name.ilike(f"%{search}%"))
+    
+    sort, sort_column, descending = admin_sort('products')
+    products, next_cursor = paginate_admin(query, Product, sort_column, descending, request.args.get('cursor'))
+    return render_template('admin/products.html', products=products, next_cursor=next_cursor,
+                         sorts=ADMIN_SORTS['products'], sort=sort, categories=Config.CATEGORIES, category=category,
+                         sellers=product_sellers(), seller_id=seller_id, status=status, search=search)
+
+def filter_admin_orders(statement):
+    """Apply the admin orders page's status, payment, seller and category filters from the query string.
+    
+    Shared by the page and the orders export, so an export matches what was on screen.
+    """
+    status = request.args.get('status', '')
+    if status in ORDER_STATUSES:
+        statement = statement.where(Order.status == status)
+    
+    payment_status = request.args.get('payment_status', '')
+    if payment_status in ('pending', 'paid', 'failed', 'expired', 'refund_due'):
+        statement = statement.where(Order.payment_status == payment_status)
+    
+    # Orders containing a product from this seller or category
+    seller_id = request.args.get('seller', type=int)
+    category = request.args.get('category', '')
+    if seller_id or category in Config.CATEGORIES:
+        # Correlated on Order alone; the orders export already joins order_item
+        items = db.select(OrderItem.id).join(Product, Product.id == OrderItem.product_id).where(
+            OrderItem.order_id == Order.id
+        ).correlate(Order)
+        if seller_id:
+            items = items.where(Product.seller_id == seller_id)
+        if category in Config.CATEGORIES:
+            items = items.where(Product.category == category)
+        statement = statement.where(items.exists())
+    return statement
 
 @app.route('/admin/orders')
 @login_required
@@ -1217,36 +3450,76 @@ def admin_orders():
         flash('Unauthorized access.', 'danger')
         return redirect(url_for('index'))
     
-    orders = Order.query.order_by(Order.created_at.desc()).all()
-    return render_template('admin/orders.html', orders=orders)
+    query = filter_admin_orders(Order.query.options(db.joinedload(Order.user)))
+    date_from = parse_admin_date(request.args.get('from'))
+    if date_from:
+        query = query.filter(Order.created_at >= date_from)
+    date_to = parse_admin_date(request.args.get('to'))
+    if date_to:
+        query = query.filter(Order.created_at < date_to + timedelta(days=1))
+    
+    status = request.args.get('status', '')
+    payment_status = request.args.get('payment_status', '')
+    seller_id = request.args.get('seller', type=int)
+    category = request.args.get('category', '')
+    sort, sort_column, descending = admin_sort('orders')
+    orders, next_cursor = paginate_admin(query, Order, sort_column, descending, request.args.get('cursor'))
+    return render_template('admin/orders.html', orders=orders, next_cursor=next_cursor,
+                         item_counts=order_item_counts(orders), statuses=ORDER_STATUSES,
+                         sorts=ADMIN_SORTS['orders'], sort=sort, status=status, payment_status=payment_status,
+                         date_from=request.args.get('from', ''), date_to=request.args.get('to', ''),
+                         sellers=product_sellers(), seller_id=seller_id, categories=Config.CATEGORIES, category=category)
 
 @app.route('/admin/analytics')
 @login_required
+@read_from_replica
 def admin_analytics():
     if not current_user.is_admin:
         flash('Unauthorized access.', 'danger')
         return redirect(url_for('index'))
     
-    total_sales = db.session.query(db.func.sum(Order.total_amount)).filter(Order.payment_status == 'paid').scalar() or 0
-    total_orders_count = Order.query.count()
+    # Everything below reads the monthly rollups, whose size does not grow with order volume
+    months = SalesRollup.query.filter_by(period='month', dimension='total').order_by(SalesRollup.period_start).all()
+    total_sales = sum(month.revenue for month in months)
+    total_orders_count = sum(month.orders for month in months)
     average_order_value = total_sales / total_orders_count if total_orders_count > 0 else 0
+    monthly_sales = [
+        {'month': month.period_start.strftime('%b %Y'), 'revenue': month.revenue, 'orders': month.orders}
+        for month in reversed(months[-6:])
+    ]
     
-    recent_orders = Order.query.order_by(Order.created_at.desc()).limit(10).all()
+    def rollup_totals(dimension):
+        return db.session.query(
+            SalesRollup.dimension_key,
+            db.func.sum(SalesRollup.revenue).label('revenue'),
+            db.func.sum(SalesRollup.units).label('quantity_sold')
+        ).filter(SalesRollup.period == 'month', SalesRollup.dimension == dimension
+        ).group_by(SalesRollup.dimension_key)
+    
+    category_sales = [
+        {'category': row.dimension_key, 'revenue': row.revenue, 'quantity_sold': row.quantity_sold}
+        for row in rollup_totals('category').order_by(db.desc('revenue')).all()
+    ]
     
-    top_products = db.session.query(
-        Product.name,
-        db.func.sum(OrderItem.quantity).label('total_sold'),
-        db.func.sum(OrderItem.quantity * OrderItem.price).label('revenue')
-    ).join(OrderItem, OrderItem.product_id == Product.id
-    ).join(Order, Order.id == OrderItem.order_id
-    ).group_by(Product.id, Product.name
-    ).order_by(db.desc('total_sold')).limit(10).all()
+    product_rows = rollup_totals('product').order_by(db.desc('quantity_sold')).limit(10).all()
+    product_names = dict(db.session.query(Product.id, Product.name).filter(
+        Product.id.in_([int(row.dimension_key) for row in product_rows])
+    ).all())
+    top_products = [
+        {'name': product_names.get(int(row.dimension_key), f"Product #{row.dimension_key}"),
+         'quantity_sold': row.quantity_sold, 'revenue': row.revenue}
+        for row in product_rows
+    ]
+    
+    recent_orders = Order.query.order_by(Order.created_at.desc()).limit(10).all()
     
     return render_template('admin/analytics.html',
                          total_sales=total_sales,
                          total_orders_count=total_orders_count,
                          average_order_value=average_order_value,
                          recent_orders=recent_orders,
+                         monthly_sales=monthly_sales,
+                         category_sales=category_sales,
                          top_products=top_products)
 
 @app.route('/admin/toggle-product/<int:product_id>')
@@ -1258,6 +3531,8 @@ def admin_toggle_product(product_id):
     
     product = Product.query.get_or_404(product_id)
     product.active = not product.active
+    get_search_backend().index_product(product)
+    invalidate_catalog()
     db.session.commit()
     
     status = "activated" if product.active else "deactivated"
@@ -1273,23 +3548,94 @@ def admin_update_order_status(order_id):
     order = Order.query.get_or_404(order_id)
     new_status = request.json.get('status')
     
-    if new_status in ['pending', 'processing', 'shipped', 'delivered', 'cancelled']:
+    if new_status in ORDER_STATUSES:
         order.status = new_status
         db.session.commit()
         return jsonify({'success': True, 'message': f'Order status updated to {new_status}'})
     
     return jsonify({'success': False, 'message': 'Invalid status'})
 
+@app.route('/admin/export/<dataset>.<fmt>')
+@login_required
+def admin_export(dataset, fmt):
+    """Stream orders (with their items), M-Pesa payments or products as CSV or NDJSON.
+    
+    Optional from/to (YYYY-MM-DD, inclusive) filter on creation date, and
+    orders also take the admin orders page's other filters. Rows
+    are written as they are fetched, so a year of orders never sits in
+    worker memory.
+    """
+    if not current_user.is_admin:
+        flash('Unauthorized access.', 'danger')
+        return redirect(url_for('index'))
+    if dataset not in EXPORTS or fmt not in ('csv', 'ndjson'):
+        return jsonify({'success': False, 'message': 'Unknown export'}), 404
+    
+    date_from = parse_admin_date(request.args.get('from'))
+    date_to = parse_admin_date(request.args.get('to'))
+    statement = EXPORTS[dataset](date_from, date_to)
+    if dataset == 'orders':
+        statement = filter_admin_orders(statement)
+    rows = export_rows(statement)
+    
+    if fmt == 'csv':
+        body, mimetype = stream_csv(rows), 'text/csv'
+    else:
+        records = nest_order_items(rows) if dataset == 'orders' else rows
+        body, mimetype = stream_ndjson(records), 'application/x-ndjson'
+    
+    filename = f"{dataset}-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.{fmt}"
+    app.logger.info("Admin export started", extra={'dataset': dataset, 'format': fmt,
+                                                   'from': request.args.get('from'), 'to': request.args.get('to')})
+    return Response(stream_with_context(body), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'Cache-Control': 'no-store',
+        'X-Accel-Buffering': 'no'
+    })
+
 # API Routes
 @app.route('/api/cart-count')
-@login_required
 def api_cart_count():
-    count = Cart.query.filter_by(user_id=current_user.id).count()
-    return jsonify({'count': count})
+    """Cart badge count, cached per user and revalidated with an ETag.
+    
+    Every open tab polls this endpoint, so the user id is read straight from
+    the signed session instead of loading the user, and an unchanged cart is
+    answered with 304 without touching the database.
+    """
+    user_id = session.get('_user_id')
+    if user_id is None:
+        if not current_user.is_authenticated:
+            return login_manager.unauthorized()
+        user_id = current_user.id
+    
+    key = f'cart-count:{user_id}'
+    entry = cache.get(key)
+    if entry is None:
+        # A random version keeps ETags from repeating across restarts and workers
+        entry = {'count': load_cart_totals(int(user_id))[0], 'version': secrets.token_hex(8)}
+        cache.set(key, entry, app.config['CART_COUNT_CACHE_TTL'])
+    
+    etag = f"cart-{user_id}-{entry['version']}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify({'count': entry['count']})
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 @app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    basename = os.path.basename(filename)
+    if not CONTENT_ADDRESSED_FILE.match(basename):
+        return storage.serve(filename)
+    
+    # Content-addressed files never change under the same name
+    response = storage.serve(filename, etag=basename, max_age=31536000)
+    if response.status_code != 302:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    return response
 
 # ADDED: Missing routes for file handling and testing
 @app.route('/favicon.ico')
@@ -1298,6 +3644,13 @@ def favicon():
 
 @app.route('/default-product.jpg')
 def default_product_image():
+    # A placeholder uploaded to storage overrides the bundled one
+    overridden = cache.get('storage-default-product')
+    if overridden is None:
+        overridden = storage.exists('default-product.jpg')
+        cache.set('storage-default-product', overridden, 300)
+    if overridden:
+        return storage.serve('default-product.jpg')
     return send_from_directory('static', 'images/default-product.jpg')
 
 @app.route('/test-payment')
@@ -1350,7 +3703,7 @@ def initiate_mpesa_payment():
         return jsonify(result), status_code
         
     except Exception as e:
-        app.logger.error(f"Error in M-Pesa payment: {str(e)}")
+        mpesa_logger.error(f"Error in M-Pesa payment: {str(e)}")
         return jsonify({
             'success': False,
             'error': 'Internal server error'
@@ -1415,6 +3768,7 @@ def internal_error(error):
 def init_db():
     with app.app_context():
         db.create_all()
+        setup_search_backend()
         
         admin_user = User.query.filter_by(email='admin@herbsstore.com').first()
         if not admin_user:
@@ -1534,21 +3888,19 @@ def init_db():
                 product = Product(**product_data)
                 db.session.add(product)
             
+            get_search_backend().rebuild()
+            invalidate_catalog()
             db.session.commit()
-            print(f"✅ Added {len(sample_products)} products to database!")
-            print("📦 ALL 19 products are now active and available!")
+            app.logger.info(f"Added {len(sample_products)} sample products to database")
         else:
-            print("✅ Database already has products, skipping sample data creation.")
+            app.logger.info("Database already has products, skipping sample data creation")
         
-        print("🔄 Restart your app to see all products on the website!")
+        if not SalesRollup.query.first() and Order.query.filter_by(payment_status='paid').first():
+            rebuild_sales_rollups()
+            db.session.commit()
+            app.logger.info("Built sales rollups from existing paid orders")
 
 if __name__ == '__main__':
-    print("🚀 Starting Herbs & Spices Store...")
     init_db()
-    print("🌐 Website: http://localhost:5000")
-    print("⚙️  Admin Panel: http://localhost:5000/admin/dashboard")
-    print("📊 Analytics: http://localhost:5000/admin/analytics")
-    print("🔑 Admin Login: admin@herbsstore.com / admin123")
-    print("💰 M-Pesa Integration: Enabled")
-    print("🌙 Dark Mode: Enabled")
+    app.logger.info("Starting Herbs & Spices Store on http://localhost:5000 (admin: admin@herbsstore.com / admin123)")
     app.run(debug=True, port=5000)
\ No newline at end of file
@@ -0,0 +1,95 @@
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Compares checkout-style writers and storefront readers sharing one SQLite
+# file from several processes, the way gunicorn workers do, with and without
+# the connection pragmas. The engine is configured at import time, so every
+# worker is a separate process started with SQLITE_TUNING set.
+
+DURATION = float(os.getenv('BENCHMARK_SECONDS', 10))
+PROCESSES = int(os.getenv('BENCHMARK_PROCESSES', 4))
+WRITERS = int(os.getenv('BENCHMARK_WRITERS', 2))  # per process
+READERS = int(os.getenv('BENCHMARK_READERS', 4))  # per process
+
+def run_workload():
+    """Run writer and reader threads for DURATION seconds and print one result line"""
+    from app import app, db, Order, build_catalog_query, paginate_catalog, reserve_stock, release_order_reservations
+
+    counts = {'writes': 0, 'reads': 0, 'locked': 0, 'errors': 0}
+    counts_lock = threading.Lock()
+    deadline = time.monotonic() + DURATION
+
+    def record(key):
+        with counts_lock:
+            counts[key] += 1
+
+    def writer():
+        # Reserve then release one unit, as a checkout followed by a failed payment would
+        with app.app_context():
+            while time.monotonic() < deadline:
+                try:
+                    order = Order(user_id=1, total_amount=100, phone_number='254700000000')
+                    db.session.add(order)
+                    db.session.flush()
+                    reserve_stock(order.id, {1: 1})
+                    db.session.commit()
+                    release_order_reservations(order.id)
+                    db.session.commit()
+                    record('writes')
+                except Exception as e:
+                    db.session.rollback()
+                    record('locked' if 'locked' in str(e) else 'errors')
+
+    def reader():
+        with app.app_context():
+            while time.monotonic() < deadline:
+                try:
+                    query, rank = build_catalog_query('all', '')
+                    paginate_catalog(query, rank=rank)
+                    Order.query.filter_by(user_id=1).order_by(Order.created_at.desc()).limit(20).all()
+                    db.session.rollback()
+                    record('reads')
+                except Exception as e:
+                    db.session.rollback()
+                    record('locked' if 'locked' in str(e) else 'errors')
+
+    threads = [threading.Thread(target=writer) for _ in range(WRITERS)]
+    threads += [threading.Thread(target=reader) for _ in range(READERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print(counts['writes'], counts['reads'], counts['locked'], counts['errors'])
+
+def run_configuration(tuning):
+    """Run PROCESSES workers against a fresh database and sum their counts"""
+    env = dict(os.environ, SQLITE_TUNING=tuning, LOG_LEVEL='CRITICAL',
+               DATABASE_URL=f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'database_benchmark.db')}",
+               UPLOAD_FOLDER=tempfile.mkdtemp())
+    subprocess.run([sys.executable, '-c', 'from app import init_db; init_db()'], env=env, check=True)
+
+    workers = [subprocess.Popen([sys.executable, __file__, '--workload'], env=env, stdout=subprocess.PIPE, text=True)
+               for _ in range(PROCESSES)]
+    totals = [0, 0, 0, 0]
+    for worker in workers:
+        output, _ = worker.communicate()
+        totals = [total + int(count) for total, count in zip(totals, output.split()[-4:])]
+    return totals
+
+def run_benchmark():
+    print(f"{PROCESSES} processes x ({WRITERS} writers + {READERS} readers), {DURATION:.0f}s per configuration\n")
+    print(f"{'configuration':<16}{'writes/s':>12}{'reads/s':>12}{'locked':>10}{'errors':>10}")
+    for label, tuning in (('default', 'false'), ('tuned', 'true')):
+        writes, reads, locked, errors = run_configuration(tuning)
+        print(f"{label:<16}{writes / DURATION:>12.1f}{reads / DURATION:>12.1f}{locked:>10}{errors:>10}")
+
+if __name__ == '__main__':
+    if '--workload' in sys.argv:
+        run_workload()
+    else:
+        run_benchmark()
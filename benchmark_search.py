@@ -0,0 +1,78 @@
+import os
+import random
+import tempfile
+import time
+
+# Point the app at a throwaway database before it reads its configuration
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'search_benchmark.db')}"
+
+import app as store
+from app import (app, db, Product, User, LikeSearchBackend, get_search_backend, setup_search_backend,
+                 build_catalog_query, paginate_catalog)
+
+PRODUCT_COUNT = int(os.getenv('BENCHMARK_PRODUCTS', 100000))
+QUERIES = ['turmeric', 'root', 'blood sugar', 'organic tea', 'cardamom pods', 'zzz']
+RUNS = 20
+
+WORDS = [
+    'organic', 'dried', 'ground', 'whole', 'premium', 'wild', 'roasted', 'fresh', 'tea', 'blend',
+    'turmeric', 'ginger', 'cinnamon', 'cardamom', 'clove', 'mint', 'basil', 'sage', 'thyme', 'nettle',
+    'root', 'leaves', 'powder', 'seeds', 'pods', 'flowers', 'digestion', 'immunity', 'sleep', 'sugar',
+]
+
+def seed_products():
+    """Insert PRODUCT_COUNT synthetic products in bulk"""
+    seller = User(email='bench@herbsstore.com', password='x', name='Bench', phone='+254700000000')
+    db.session.add(seller)
+    db.session.commit()
+
+    rows = []
+    for i in range(PRODUCT_COUNT):
+        rows.append({
+            'name': ' '.join(random.sample(WORDS, 3)).title(),
+            'description': ' '.join(random.choices(WORDS, k=25)),
+            'price': random.randint(50, 1000),
+            'category': random.choice(app.config['CATEGORIES']),
+            'stock': random.randint(0, 100),
+            'seller_id': seller.id,
+            'active': True,
+        })
+    db.session.execute(db.insert(Product), rows)
+    db.session.commit()
+
+def time_search(search):
+    """Return the median latency in milliseconds of the first result page for a search"""
+    timings = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        query, rank = build_catalog_query('all', search)
+        paginate_catalog(query, rank=rank)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+def run_benchmark():
+    with app.app_context():
+        db.create_all()
+        random.seed(42)
+        print(f"Seeding {PRODUCT_COUNT} products...")
+        seed_products()
+        # Build the index over the seeded rows, as init_db() does
+        setup_search_backend()
+
+        backend = get_search_backend()
+        print(f"Search backend: {backend.name}\n")
+        if backend.name == 'like':
+            print("No search index was built, so there is nothing to compare against LIKE")
+            return
+
+        print(f"{'query':<16}{backend.name + ' (ms)':>14}{'like (ms)':>14}")
+        for search in QUERIES:
+            indexed = time_search(search)
+            store._search_backend = LikeSearchBackend()
+            scanned = time_search(search)
+            store._search_backend = backend
+            print(f"{search:<16}{indexed:>14.2f}{scanned:>14.2f}")
+
+if __name__ == '__main__':
+    run_benchmark()
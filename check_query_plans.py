@@ -0,0 +1,148 @@
+import os
+import re
+import sys
+import tempfile
+import threading
+from datetime import datetime, timedelta
+
+# Point the app at a throwaway database before it reads its configuration,
+# and apply callbacks inline so their queries run in the request
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'query_plans.db')}"
+os.environ['UPLOAD_FOLDER'] = tempfile.mkdtemp()
+os.environ['MPESA_CALLBACK_FAST_ACK'] = 'false'
+
+from werkzeug.security import generate_password_hash
+
+from app import app, db, init_db, Cart, MpesaPayment, Order, OrderItem, User
+
+# Requests that run the hot queries, with the tables each one may scan in
+# full. Only queries that aggregate a whole table, or walk it in primary key
+# order under a LIMIT (SQLite reports that as a scan too), are allowed to.
+HOT_REQUESTS = [
+    ('buyer', 'GET', '/', set()),
+    ('buyer', 'GET', '/?category=Spices', set()),
+    ('buyer', 'GET', '/?search=root', set()),
+    ('buyer', 'GET', '/products/1', set()),
+    ('buyer', 'GET', '/cart', set()),
+    ('buyer', 'POST', '/update-cart/1', set()),
+    ('buyer', 'GET', '/api/cart-count', set()),
+    ('buyer', 'GET', '/checkout', set()),
+    ('buyer', 'GET', '/orders', set()),
+    ('buyer', 'GET', '/check-payment-status/1', set()),
+    (None, 'POST', '/mpesa-callback', set()),
+    ('admin', 'GET', '/my-products', set()),
+    ('admin', 'GET', '/admin/dashboard', {'user', 'order'}),
+    ('admin', 'GET', '/admin/products', set()),
+    ('admin', 'GET', '/admin/orders', set()),
+    ('admin', 'GET', '/admin/orders?payment_status=paid', set()),
+    ('admin', 'GET', '/admin/users', {'user'}),
+    ('admin', 'GET', '/admin/analytics', set()),
+]
+
+# Most queries each request may run, counting the logged-in user's lookup,
+# so that a lazy load inside a template loop shows up as a failure
+QUERY_BUDGETS = {
+    '/cart': 2,
+    '/update-cart/1': 4,
+    '/api/cart-count': 1,
+    '/checkout': 3,
+    '/admin/dashboard': 4,
+    '/admin/products': 3,
+    '/admin/orders': 4,
+    '/admin/users': 2,
+}
+
+FULL_SCAN = re.compile(r'^SCAN (\w+)$')
+
+def seed():
+    """Add a buyer with a cart, paid and pending orders and their payments"""
+    buyer = User(email='plans@herbsstore.com', password=generate_password_hash('plans123'),
+                 name='Plans', phone='0712345678', verified=True)
+    db.session.add(buyer)
+    db.session.flush()
+    for product_id in (1, 2):
+        db.session.add(Cart(user_id=buyer.id, product_id=product_id, quantity=1))
+    for i in range(3):
+        order = Order(user_id=buyer.id, total_amount=100, phone_number='254712345678',
+                      payment_status='paid' if i else 'pending', created_at=datetime.utcnow() - timedelta(days=i))
+        db.session.add(order)
+        db.session.flush()
+        db.session.add(OrderItem(order_id=order.id, product_id=i + 1, product_name=f'Product {i + 1}', quantity=1, price=100))
+        db.session.add(MpesaPayment(order_id=order.id, checkout_request_id=f'ws_plans_{i}',
+                                    phone_number='254712345678', amount=100, status='pending'))
+    db.session.commit()
+
+def callback_body():
+    return {'Body': {'stkCallback': {
+        'MerchantRequestID': 'm1', 'CheckoutRequestID': 'ws_plans_0', 'ResultCode': 0, 'ResultDesc': 'ok',
+        'CallbackMetadata': {'Item': [{'Name': 'MpesaReceiptNumber', 'Value': 'QPLANS'},
+                                      {'Name': 'TransactionDate', 'Value': 20261018120000}]}
+    }}}
+
+# Bodies for the POST requests above; cart 1 is the buyer's first seeded item
+REQUEST_BODIES = {
+    '/update-cart/1': {'data': {'quantity': 2}},
+    '/mpesa-callback': {'json': callback_body()},
+}
+
+def explain(connection, statement, parameters):
+    """Return the EXPLAIN QUERY PLAN detail lines for a statement"""
+    rows = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+    return [row[-1] for row in rows]
+
+def run_check():
+    app.config['WTF_CSRF_ENABLED'] = False
+    init_db()
+    tables = set(db.metadata.tables)
+    captured = []
+    request_thread = threading.get_ident()
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        # Background workers share the engine; only this thread's queries count
+        if threading.get_ident() == request_thread and statement.lstrip().upper().startswith('SELECT'):
+            captured.append((statement, parameters))
+
+    with app.app_context():
+        seed()
+        engine = db.engine
+    db.event.listen(engine, 'before_cursor_execute', capture)
+
+    # Requests run outside any outer app context so each gets its own g
+    clients = {None: app.test_client(), 'buyer': app.test_client(), 'admin': app.test_client()}
+    clients['buyer'].post('/login', data={'email': 'plans@herbsstore.com', 'password': 'plans123'})
+    clients['admin'].post('/login', data={'email': 'admin@herbsstore.com', 'password': 'admin123'})
+
+    failures = 0
+    with engine.connect() as connection:
+        for user, method, path, allowed in HOT_REQUESTS:
+            captured.clear()
+            kwargs = REQUEST_BODIES.get(path, {})
+            try:
+                status_code = clients[user].open(path, method=method, **kwargs).status_code
+            except Exception as e:
+                # Queries run before rendering, so a broken template still gets checked
+                status_code = type(e).__name__
+            statements = list(dict.fromkeys(captured))
+            scans = set()
+            for statement, parameters in statements:
+                for detail in explain(connection, statement, parameters):
+                    match = FULL_SCAN.match(detail)
+                    # joinedload aliases tables as product_1 and so on
+                    table = re.sub(r'_\d+$', '', match.group(1)) if match else None
+                    if table in tables and table not in allowed:
+                        scans.add(table)
+                        print(f"    full scan of {table}: {' '.join(statement.split())[:160]}")
+            over_budget = len(captured) > QUERY_BUDGETS.get(path, len(captured))
+            if over_budget:
+                print(f"    {len(captured)} queries, budget is {QUERY_BUDGETS[path]}")
+            status = 'FAIL' if scans or over_budget else 'ok'
+            print(f"{status:<5}{method:<5}{path:<36}{status_code}  {len(captured)} queries")
+            failures += bool(scans or over_budget)
+
+    if failures:
+        print(f"❌ {failures} request(s) scan whole tables or run too many queries")
+        sys.exit(1)
+    print('✅ Every hot query uses an index')
+
+if __name__ == '__main__':
+    run_check()
@@ -0,0 +1,51 @@
+import os
+from PIL import Image, ImageOps
+
+# Kept free of Flask and database imports so image worker processes start
+# quickly and never touch the app's connections.
+
+def image_variant_formats(primary_format):
+    """(PIL format, extension, MIME type) for each variant written, preferred first"""
+    formats = [('WEBP', '.webp', 'image/webp')]
+    Image.init()
+    if 'AVIF' in Image.SAVE:
+        formats.insert(0, ('AVIF', '.avif', 'image/avif'))
+    if primary_format == 'JPEG':
+        formats.append(('JPEG', '.jpg', 'image/jpeg'))
+    else:
+        formats.append(('PNG', '.png', 'image/png'))
+    return formats
+
+def render_image_variants(source_path, output_dir, stem, primary_format, widths):
+    """Decode an image and write it at every width in each variant format.
+
+    Never upscales. Returns (primary MIME type, {mime_type: {width: filename}},
+    filename of the largest primary-format variant).
+    """
+    max_width = max(widths)
+    i = Image.open(source_path)
+    # Let the JPEG decoder downscale while decoding large phone photos
+    i.draft('RGB', (max_width, max_width))
+    i = ImageOps.exif_transpose(i)
+
+    if i.mode in ('RGBA', 'LA', 'P'):
+        i = i.convert('RGBA')
+        background = Image.new('RGB', i.size, (255, 255, 255))
+        background.paste(i, mask=i.split()[-1])
+        i = background
+    elif i.mode != 'RGB':
+        i = i.convert('RGB')
+
+    widths = sorted({min(width, i.width) for width in widths})
+    variants = {}
+    for width in reversed(widths):
+        height = max(1, round(i.height * width / i.width))
+        # Each variant is resized from the previous, larger one
+        i = i.resize((width, height), Image.Resampling.LANCZOS) if width != i.width else i
+        for image_format, extension, mime_type in image_variant_formats(primary_format):
+            filename = f"{stem}-{width}{extension}"
+            i.save(os.path.join(output_dir, filename), image_format, quality=82)
+            variants.setdefault(mime_type, {})[str(width)] = filename
+
+    primary_type = 'image/jpeg' if primary_format == 'JPEG' else 'image/png'
+    return primary_type, variants, variants[primary_type][str(widths[-1])]
@@ -0,0 +1,46 @@
+"""Add indexes for hot lookup columns
+
+Revision ID: 3c9a1f5e2b7d
+Revises: d50a2c412a1f
+Create Date: 2026-10-18 20:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c9a1f5e2b7d'
+down_revision = 'd50a2c412a1f'
+branch_labels = None
+depends_on = None
+
+# (index name, table, columns). Databases created by init_db() already have
+# these from the models, so every index is created only if missing.
+INDEXES = [
+    ('ix_product_active_created_at', 'product', ['active', 'created_at', 'id']),
+    ('ix_product_active_category_created_at', 'product', ['active', 'category', 'created_at', 'id']),
+    ('ix_product_seller_id_created_at', 'product', ['seller_id', 'created_at']),
+    ('ix_product_created_at', 'product', ['created_at']),
+    ('ix_cart_user_id_product_id', 'cart', ['user_id', 'product_id']),
+    ('ix_order_user_id_created_at', 'order', ['user_id', 'created_at']),
+    ('ix_order_created_at', 'order', ['created_at']),
+    ('ix_order_payment_status_created_at', 'order', ['payment_status', 'created_at']),
+    ('ix_order_item_order_id', 'order_item', ['order_id']),
+    ('ix_order_item_product_id', 'order_item', ['product_id']),
+    ('ix_mpesa_payment_order_id_created_at', 'mpesa_payment', ['order_id', 'created_at']),
+]
+
+
+def upgrade():
+    # Build indexes without locking writes on Postgres; CONCURRENTLY cannot
+    # run inside a transaction, hence the autocommit block
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, if_not_exists=True, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, if_exists=True, postgresql_concurrently=True)
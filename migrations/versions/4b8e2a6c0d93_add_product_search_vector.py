@@ -0,0 +1,45 @@
+"""Add the Postgres full-text search column and index
+
+Revision ID: 4b8e2a6c0d93
+Revises: 9c4e7b1d2f05
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b8e2a6c0d93'
+down_revision = '9c4e7b1d2f05'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # SQLite keeps its FTS5 index in a virtual table that init_db() builds
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    # Postgres keeps the generated column current on every write
+    op.execute(
+        "ALTER TABLE product ADD COLUMN IF NOT EXISTS search_vector tsvector "
+        "GENERATED ALWAYS AS ("
+        "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+        "setweight(to_tsvector('english', coalesce(category, '')), 'B') || "
+        "setweight(to_tsvector('english', coalesce(description, '')), 'C')"
+        ") STORED"
+    )
+    with op.get_context().autocommit_block():
+        op.create_index('ix_product_search_vector', 'product', ['search_vector'], postgresql_using='gin',
+                        if_not_exists=True, postgresql_concurrently=True)
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_product_search_vector', table_name='product', if_exists=True,
+                      postgresql_concurrently=True)
+    op.execute("ALTER TABLE product DROP COLUMN IF EXISTS search_vector")
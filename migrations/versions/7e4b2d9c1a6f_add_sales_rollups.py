@@ -0,0 +1,40 @@
+"""Add daily and monthly sales rollups
+
+Revision ID: 7e4b2d9c1a6f
+Revises: 3c9a1f5e2b7d
+Create Date: 2026-10-18 22:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7e4b2d9c1a6f'
+down_revision = '3c9a1f5e2b7d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # init_db() creates the table from the model on new databases and
+    # backfills it from paid orders when it is empty
+    op.create_table(
+        'sales_rollup',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('period', sa.String(length=10), nullable=False),
+        sa.Column('period_start', sa.Date(), nullable=False),
+        sa.Column('dimension', sa.String(length=20), nullable=False),
+        sa.Column('dimension_key', sa.String(length=100), nullable=False),
+        sa.Column('revenue', sa.Float(), nullable=False),
+        sa.Column('units', sa.Integer(), nullable=False),
+        sa.Column('orders', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('period', 'dimension', 'dimension_key', 'period_start',
+                            name='uq_sales_rollup_period_dimension_key_start'),
+        if_not_exists=True
+    )
+
+
+def downgrade():
+    op.drop_table('sales_rollup', if_exists=True)
@@ -0,0 +1,30 @@
+"""Record failed image uploads on products
+
+Revision ID: 9c4e7b1d2f05
+Revises: f2d07efb2940
+Create Date: 2026-10-19 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c4e7b1d2f05'
+down_revision = 'f2d07efb2940'
+branch_labels = None
+depends_on = None
+
+
+def columns(table):
+    return {column['name'] for column in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def upgrade():
+    if 'image_error' not in columns('product'):
+        op.add_column('product', sa.Column('image_error', sa.String(length=255), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('product') as batch_op:
+        batch_op.drop_column('image_error')
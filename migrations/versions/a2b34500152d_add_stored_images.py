@@ -0,0 +1,48 @@
+"""Store uploads by content hash
+
+Revision ID: a2b34500152d
+Revises: ded91f3fee20
+Create Date: 2026-10-19 09:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a2b34500152d'
+down_revision = 'ded91f3fee20'
+branch_labels = None
+depends_on = None
+
+
+def columns(table):
+    return {column['name'] for column in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def upgrade():
+    # init_db() builds new databases from the models, which already match
+    op.create_table(
+        'stored_image',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('sha256', sa.String(length=64), nullable=False),
+        sa.Column('manifest', sa.Text(), nullable=False),
+        sa.Column('ref_count', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('sha256'),
+        if_not_exists=True
+    )
+
+    # Existing uploads keep a NULL hash; attach_product_image() treats them
+    # as owned by their product alone
+    if 'image_hash' not in columns('product'):
+        op.add_column('product', sa.Column('image_hash', sa.String(length=64), nullable=True))
+    op.create_index('ix_product_image_hash', 'product', ['image_hash'], if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_product_image_hash', table_name='product', if_exists=True)
+    with op.batch_alter_table('product') as batch_op:
+        batch_op.drop_column('image_hash')
+    op.drop_table('stored_image', if_exists=True)
@@ -0,0 +1,160 @@
+"""Make OrderItem the only copy of an order's line items
+
+Revision ID: b81f6c3d4e2a
+Revises: 7e4b2d9c1a6f
+Create Date: 2026-10-18 23:30:00.000000
+
+"""
+import json
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b81f6c3d4e2a'
+down_revision = '7e4b2d9c1a6f'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+order = sa.table(
+    'order',
+    sa.column('id', sa.Integer),
+    sa.column('order_items', sa.Text)
+)
+order_item = sa.table(
+    'order_item',
+    sa.column('id', sa.Integer),
+    sa.column('order_id', sa.Integer),
+    sa.column('product_id', sa.Integer),
+    sa.column('product_name', sa.String),
+    sa.column('quantity', sa.Integer),
+    sa.column('price', sa.Float)
+)
+product = sa.table(
+    'product',
+    sa.column('id', sa.Integer),
+    sa.column('name', sa.String)
+)
+
+
+def columns(table):
+    return {column['name'] for column in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def legacy_items(raw):
+    """The line items stored in an order's JSON column, skipping anything unreadable.
+
+    Each item comes back with an int product_id and quantity and a float
+    price, so one hand-edited order cannot abort the whole migration.
+    """
+    try:
+        items = json.loads(raw or '[]')
+    except ValueError:
+        return []
+    if not isinstance(items, list):
+        return []
+
+    cleaned = []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        try:
+            product_id = int(item['product_id'])
+            quantity = int(item.get('quantity') or 1)
+            price = float(item.get('price') or 0)
+        except (KeyError, TypeError, ValueError, OverflowError):
+            continue
+        name = item.get('product_name')
+        cleaned.append({
+            'product_id': product_id,
+            'product_name': str(name)[:100] if name else None,
+            'quantity': quantity,
+            'price': price
+        })
+    return cleaned
+
+
+def upgrade():
+    # init_db() builds new databases from the models, which already match
+    if 'product_name' not in columns('order_item'):
+        op.add_column('order_item', sa.Column('product_name', sa.String(length=100), nullable=True))
+
+    if 'order_items' in columns('order'):
+        backfill_order_items()
+        with op.batch_alter_table('order') as batch_op:
+            batch_op.drop_column('order_items')
+
+    # Anything the JSON did not name takes the product's current name
+    connection = op.get_bind()
+    connection.execute(order_item.update().where(order_item.c.product_name.is_(None)).values(
+        product_name=sa.func.coalesce(
+            sa.select(product.c.name).where(product.c.id == order_item.c.product_id).scalar_subquery(),
+            sa.literal('Product #') + sa.cast(order_item.c.product_id, sa.String)
+        )
+    ))
+    with op.batch_alter_table('order_item') as batch_op:
+        batch_op.alter_column('product_name', existing_type=sa.String(length=100), nullable=False)
+
+
+def backfill_order_items():
+    """Copy names from the JSON into existing items, and create items for orders that only have JSON"""
+    connection = op.get_bind()
+    last_id = 0
+    while True:
+        orders = connection.execute(
+            sa.select(order.c.id, order.c.order_items).where(order.c.id > last_id)
+            .order_by(order.c.id).limit(BATCH_SIZE)
+        ).all()
+        if not orders:
+            return
+        last_id = orders[-1].id
+
+        existing = {}
+        for row in connection.execute(
+            sa.select(order_item.c.id, order_item.c.order_id, order_item.c.product_id)
+            .where(order_item.c.order_id.in_([o.id for o in orders]))
+        ):
+            existing.setdefault(row.order_id, []).append(row)
+
+        new_items = []
+        for o in orders:
+            items = legacy_items(o.order_items)
+            if o.id not in existing:
+                new_items += [dict(item, order_id=o.id) for item in items]
+                continue
+            names = {item['product_id']: item['product_name'] for item in items}
+            for row in existing[o.id]:
+                if names.get(row.product_id):
+                    connection.execute(order_item.update().where(order_item.c.id == row.id)
+                                       .values(product_name=names[row.product_id]))
+        if new_items:
+            connection.execute(order_item.insert(), new_items)
+
+
+def downgrade():
+    with op.batch_alter_table('order') as batch_op:
+        batch_op.add_column(sa.Column('order_items', sa.Text(), nullable=True))
+
+    connection = op.get_bind()
+    items = {}
+    for row in connection.execute(
+        sa.select(order_item.c.order_id, order_item.c.product_id, order_item.c.product_name,
+                  order_item.c.quantity, order_item.c.price).order_by(order_item.c.order_id, order_item.c.id)
+    ):
+        items.setdefault(row.order_id, []).append({
+            'product_id': row.product_id,
+            'product_name': row.product_name,
+            'quantity': row.quantity,
+            'price': row.price
+        })
+    for order_id, order_items in items.items():
+        connection.execute(order.update().where(order.c.id == order_id).values(order_items=json.dumps(order_items)))
+    connection.execute(order.update().where(order.c.order_items.is_(None)).values(order_items='[]'))
+
+    with op.batch_alter_table('order') as batch_op:
+        batch_op.alter_column('order_items', existing_type=sa.Text(), nullable=False)
+    with op.batch_alter_table('order_item') as batch_op:
+        batch_op.drop_column('product_name')
@@ -0,0 +1,31 @@
+"""Add the resized image manifest to products
+
+Revision ID: ded91f3fee20
+Revises: b81f6c3d4e2a
+Create Date: 2026-10-19 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'ded91f3fee20'
+down_revision = 'b81f6c3d4e2a'
+branch_labels = None
+depends_on = None
+
+
+def columns(table):
+    return {column['name'] for column in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def upgrade():
+    # Existing products keep a NULL manifest and fall back to their bundled image
+    if 'image_manifest' not in columns('product'):
+        op.add_column('product', sa.Column('image_manifest', sa.Text(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('product') as batch_op:
+        batch_op.drop_column('image_manifest')
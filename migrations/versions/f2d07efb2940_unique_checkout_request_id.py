@@ -0,0 +1,61 @@
+"""Make M-Pesa checkout request IDs unique
+
+Revision ID: f2d07efb2940
+Revises: a2b34500152d
+Create Date: 2026-10-19 09:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2d07efb2940'
+down_revision = 'a2b34500152d'
+branch_labels = None
+depends_on = None
+
+mpesa_payment = sa.table(
+    'mpesa_payment',
+    sa.column('id', sa.Integer),
+    sa.column('checkout_request_id', sa.String)
+)
+
+
+def is_unique(table, column):
+    """Whether init_db() already made the column unique from the model"""
+    inspector = sa.inspect(op.get_bind())
+    return any(
+        constraint['column_names'] == [column]
+        for constraint in inspector.get_unique_constraints(table) + inspector.get_indexes(table)
+        if constraint.get('unique', True)
+    )
+
+
+def upgrade():
+    if is_unique('mpesa_payment', 'checkout_request_id'):
+        return
+
+    # Callbacks look payments up by this ID, so a repeated one can only ever
+    # reach the newest payment; detach it from the older ones
+    connection = op.get_bind()
+    duplicates = connection.execute(
+        sa.select(mpesa_payment.c.checkout_request_id, sa.func.max(mpesa_payment.c.id).label('keep_id'))
+        .where(mpesa_payment.c.checkout_request_id.is_not(None))
+        .group_by(mpesa_payment.c.checkout_request_id)
+        .having(sa.func.count() > 1)
+    ).all()
+    for row in duplicates:
+        connection.execute(
+            mpesa_payment.update()
+            .where(mpesa_payment.c.checkout_request_id == row.checkout_request_id,
+                   mpesa_payment.c.id != row.keep_id)
+            .values(checkout_request_id=None)
+        )
+
+    op.create_index('ix_mpesa_payment_checkout_request_id', 'mpesa_payment', ['checkout_request_id'],
+                    unique=True, if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_mpesa_payment_checkout_request_id', table_name='mpesa_payment', if_exists=True)
@@ -100,8 +100,11 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     });
     
-    // Update cart count periodically
+    // Update cart count periodically; hidden tabs skip the request entirely
     function updateCartCount() {
+        if (document.hidden) {
+            return;
+        }
         if (document.querySelector('.cart-link')) {
             fetch('/api/cart-count')
                 .then(response => response.json())
@@ -115,8 +118,9 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
     
-    // Update cart count every 30 seconds
+    // Update cart count every 30 seconds, and as soon as a hidden tab is shown again
     setInterval(updateCartCount, 30000);
+    document.addEventListener('visibilitychange', updateCartCount);
     
     // Touch device improvements
     if ('ontouchstart' in window) {
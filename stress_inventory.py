@@ -0,0 +1,75 @@
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Point the app at a throwaway database before it reads its configuration
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'inventory_stress.db')}"
+
+from app import app, db, Order, Product, StockReservation, User, reserve_stock, release_order_reservations
+
+STOCK = int(os.getenv('STRESS_STOCK', 50))
+BUYERS = int(os.getenv('STRESS_BUYERS', 200))
+THREADS = int(os.getenv('STRESS_THREADS', 32))
+
+start_line = threading.Barrier(THREADS)
+
+def setup():
+    """Create one buyer and a single SKU with STOCK units"""
+    db.create_all()
+    buyer = User(email='stress@herbsstore.com', password='x', name='Stress', phone='+254700000000')
+    db.session.add(buyer)
+    db.session.flush()
+    product = Product(name='Cloves', description='Stress SKU', price=100, category='Spices',
+                      stock=STOCK, seller_id=buyer.id)
+    db.session.add(product)
+    db.session.commit()
+    return buyer.id, product.id
+
+def buy(buyer_id, product_id, attempt):
+    """Run one checkout's reservation, retrying while SQLite holds the write lock"""
+    if attempt < THREADS:
+        start_line.wait()
+    with app.app_context():
+        for _ in range(20):
+            try:
+                order = Order(user_id=buyer_id, total_amount=100, phone_number='254700000000')
+                db.session.add(order)
+                db.session.flush()
+                if not reserve_stock(order.id, {product_id: 1}):
+                    db.session.rollback()
+                    return False
+                db.session.commit()
+                return order.id
+            except Exception:
+                db.session.rollback()
+        raise RuntimeError('database stayed locked')
+
+def run_stress():
+    with app.app_context():
+        buyer_id, product_id = setup()
+
+    with ThreadPoolExecutor(max_workers=THREADS) as pool:
+        results = list(pool.map(lambda i: buy(buyer_id, product_id, i), range(BUYERS)))
+
+    orders = [order_id for order_id in results if order_id]
+    with app.app_context():
+        stock = db.session.get(Product, product_id).stock
+        held = StockReservation.query.filter_by(status='held').count()
+        print(f"{BUYERS} buyers, {THREADS} threads, {STOCK} in stock")
+        print(f"successful reservations: {len(orders)}, remaining stock: {stock}, held reservations: {held}")
+        assert len(orders) == STOCK and stock == 0 and held == STOCK, 'inventory oversold or lost'
+
+        # Failed payments hand every unit back exactly once, even if released twice
+        for order_id in orders:
+            release_order_reservations(order_id)
+            release_order_reservations(order_id)
+        db.session.commit()
+        stock = db.session.get(Product, product_id).stock
+        print(f"stock after releasing every reservation: {stock}")
+        assert stock == STOCK, 'released stock does not add up'
+
+    print('OK: no overselling')
+
+if __name__ == '__main__':
+    run_stress()